@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import shlex
+import signal
+import subprocess as sp
+import time
+from RCFNavigator import (RCFNavigator, CondorQuery, JobTable, QueueCache, NodeChecker, JobRemover, LongKiller,
+                          ResubmitEngine, JobMonitor, metrics, node_index)
+
+
+class AsyncNavigator:
+    """
+    asyncio counterpart of RCFNavigator: the command runs as an asyncio subprocess, so many of them
+    (and anything else) can run in one event loop while waiting. Awaiting the navigator runs it, e.g.
+        navigator = await AsyncNavigator(['condor_q', '-af:t', 'ClusterId'], timeout=60)
+        print(navigator.get_output())
+    Cancelling the awaiting task kills the command, together with whatever it started.
+    """
+    def __init__(self, command, timeout=None, remote=None):
+        """
+        :param command: shell string or argument list (run without shell)
+        :param timeout: seconds before the command is killed, None to wait forever
+        :param remote: run the command through this remote interface instead of RCFNavigator.remote
+        """
+        self.command = command
+        self.timeout = timeout
+        self.remote = remote or RCFNavigator.remote
+        self.timed_out = False
+        self.out = self.err = b''
+        self.p = None
+
+    def __await__(self):
+        return self.run().__await__()
+
+    async def run(self):
+        """
+        Run the command
+        :return: the navigator itself, finished
+        """
+        start = time.monotonic()
+        command = self.command
+        if self.remote is not None:
+            # the SSH channels block, they get a thread of the loop's pool
+            code, self.out, self.err = await asyncio.to_thread(
+                self.remote.run, command if isinstance(command, str) else shlex.join(command), timeout=self.timeout)
+            self.p = sp.CompletedProcess(command, code, self.out, self.err)
+            self.timed_out = code == -1
+            metrics.record(command, time.monotonic() - start, len(self.out), code, self.err)
+            return self
+        # own process group, so that killing it also kills whatever a shell command started
+        if isinstance(command, str):
+            self.p = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        else:
+            self.p = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                          stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        try:
+            self.out, self.err = await asyncio.wait_for(self.p.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            self.kill()
+            await self.p.wait()
+            self.timed_out = True
+            self.err += f'\nTimed out after {self.timeout} s\n'.encode()
+        except asyncio.CancelledError:
+            self.kill()
+            raise
+        metrics.record(command, time.monotonic() - start, len(self.out), self.p.returncode, self.err)
+        return self
+
+    def kill(self):
+        """
+        Kill the command and everything it started
+        """
+        try:
+            os.killpg(self.p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def get_process(self):
+        """
+        :return: the asyncio process (CompletedProcess when remote), its returncode is set once finished
+        """
+        return self.p
+
+    def get_output(self):
+        """
+        :return: the std output of the process
+        """
+        return self.out
+
+    def get_error(self):
+        """
+        :return: the std error of the process
+        """
+        return self.err
+
+
+async def query(glob=False, user=None, timeout=None, constraint=None, attributes=None):
+    """
+    The same query as CondorQuery.table(), with the schedds of a global query asked at the same time
+    :param glob: all schedds instead of the local one
+    :param user: owner of the jobs, default is $USER
+    :param timeout: seconds before giving up on condor_q
+    :param constraint: only the jobs matching this Constraint
+    :param attributes: the attributes needed, default is all of them
+    :return: the parsed JobTable
+    """
+    condor = CondorQuery(glob=glob, user=user, timeout=timeout, constraint=constraint, attributes=attributes)
+    if glob and condor.fan_out:
+        schedds = CondorQuery.known_schedds()
+        if schedds is None:
+            schedds = CondorQuery.parse_schedds(await AsyncNavigator(CondorQuery.status_command,
+                                                                     CondorQuery.schedd_timeout))
+        if schedds:
+            workers = asyncio.Semaphore(condor.workers)
+
+            async def query_schedd(name):
+                command, schedd_timeout = condor.schedd_command(name)
+                async with workers:
+                    navigator = await AsyncNavigator(command, schedd_timeout)
+                return condor.schedd_table(name, navigator, schedd_timeout)
+            return JobTable.merge(await asyncio.gather(*map(query_schedd, schedds)))
+    navigator = await AsyncNavigator(condor.command, timeout)
+    return condor.parse(navigator.get_output(), navigator.get_error())
+
+
+class AsyncQueueCache(QueueCache):
+    """
+    A QueueCache that is filled from the event loop: await fetch() before handing the cache to the
+    synchronous classes (NodeChecker, LongKiller, JobMonitor.check_queue), which then find a fresh
+    snapshot and do not query condor themselves. Tasks and threads asking for the same snapshot share
+    one query, and the lock is never held while condor answers, so a thread querying does not stop the loop.
+    The synchronous classes still run in threads (asyncio.to_thread): when the snapshot was dropped in
+    between, they wait for a query another task of the loop is running, which must not be the loop itself.
+    """
+
+    async def fetch(self, glob=False, user=None, constraint=None, attributes=None):
+        """
+        Get the job table from the cache, query condor without blocking the loop if there is no fresh snapshot
+        :param glob: all schedds (-global) instead of the local one
+        :param user: owner of the jobs, default is $USER
+        :param constraint: only the jobs matching this Constraint
+        :param attributes: the attributes needed, see CondorQuery
+        :return: the JobTable
+        """
+        snapshot = self.peek(glob, user, constraint, attributes)
+        if snapshot is not None:
+            return snapshot
+        key = self.key(glob, user, constraint, attributes)
+        future, generation = self.claim(key)
+        if generation is None:
+            # shielded, a task giving up must not cancel the query for the others
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            snapshot = await query(glob, user, self.timeout, constraint, attributes)
+        except BaseException as error:
+            self.finish(key, future, generation, error=error)
+            raise
+        self.finish(key, future, generation, snapshot)
+        return snapshot
+
+
+# shared by everything in this module unless told otherwise
+queue_cache = AsyncQueueCache()
+
+
+async def check_node(cache=None, cwd=None, index=None):
+    """
+    Async NodeChecker
+    :param cache: AsyncQueueCache to build the index from, default is the shared one
+    :param cwd: directory of the jobs (with trailing '/'), default is the current working directory
+    :param index: NodeIndex to look the directory up in, default is the shared one
+    :return: the NodeChecker, see get_node() and get_nodes()
+    """
+    cache = cache or queue_cache
+    if (index or node_index).load(NodeChecker.user) is None:
+        await cache.fetch(glob=True, user=NodeChecker.user)
+    return await asyncio.to_thread(NodeChecker, cache, cwd, index)
+
+
+async def find_long(_day, _hour=0, local=False, cache=None, cwd=None, **options):
+    """
+    Async LongKiller, takes the same arguments
+    :return: the LongKiller, with the bad jobs found
+    """
+    cache = cache or queue_cache
+    hours = None if options.get('percentile') is not None else _day * 24 + _hour
+    await cache.fetch(not local, LongKiller.user, LongKiller.query(cwd or LongKiller.cwd, hours), LongKiller.attributes)
+    return await asyncio.to_thread(LongKiller, _day, _hour, local, cache, cwd, **options)
+
+
+async def remove_jobs(remover):
+    """
+    Run the condor_rm (or condor_release) calls of a JobRemover at the same time
+    :param remover: the JobRemover or JobReleaser
+    :return: dictionary of job id -> True if it was removed (released)
+    """
+    async def run(args, chunk):
+        return remover.outcome(chunk, await AsyncNavigator(args))
+    results = {}
+    for outcome in await asyncio.gather(*(run(args, chunk) for args, chunk in remover.batches())):
+        results.update(outcome)
+    return results
+
+
+async def kill_bad_job(killer):
+    """
+    Async LongKiller.kill_bad_job(). Nobody can answer a question in an event loop, so the node is not checked
+    :param killer: the LongKiller
+    :return: dictionary of job id -> True if it was removed
+    """
+    print(f'Killing {len(killer.bad_id_list)} jobs that have been running for more than {killer.hour_threshold:g} hours')
+    return killer.killed(await remove_jobs(JobRemover(killer.bad_id_list, killer.bad_schedd_list, killer.table)))
+
+
+async def resubmit_jobs(engine):
+    """
+    Async ResubmitEngine.run(), with the same limits on concurrent calls and rate
+    :param engine: the ResubmitEngine
+    :return: dictionary of sched name -> True if its group was resubmitted successfully
+    """
+    workers = asyncio.Semaphore(engine.workers)
+
+    async def submit(session, names):
+        if not os.path.isfile(session):
+            return engine.record(names, False, f'{session} not found')
+        async with workers:
+            await asyncio.sleep(engine.limiter.delay())
+            navigator = await AsyncNavigator(engine.command(session, names))
+        output = (navigator.get_output() + navigator.get_error()).decode('utf-8', 'replace')
+        engine.record(names, navigator.get_process().returncode == 0, output)
+    await asyncio.gather(*(submit(session, names) for session, names in engine.groups()))
+    return engine.outcomes
+
+
+class AsyncJobMonitor(JobMonitor):
+    """
+    JobMonitor in an event loop: queue queries, kills and resubmissions are asyncio subprocesses, and
+    the blocking parts (releases, the missing files, the email) run in threads of the loop, so many
+    monitors (and a status endpoint) can share one process and one cache, e.g.
+        start([AsyncJobMonitor('me@bnl.gov', cwd='/star/data01/pwg/me/run1/'),
+               AsyncJobMonitor('me@bnl.gov', cwd='/star/data01/pwg/me/run2/')], status_path='/tmp/me.status')
+    The wait between checks is a task that check_now() (Ctrl+\\) cancels.
+    """
+    def __init__(self, email, days=1, hours=0, debug=False, glob=False, cache=None, tracker=None, cwd=None,
+                 percentile=None):
+        """
+        Same as JobMonitor, an unaccessible node is retried by watch() instead of inside check_queue()
+        :param cache: AsyncQueueCache to take the queue from, default is the shared one
+        """
+        super().__init__(email, days, hours, debug, glob, cache or queue_cache, tracker, cwd, retry=False,
+                         percentile=percentile)
+        self.unreachable = False
+        self.sleeper = None
+        self.next_check = None
+        self.done = False
+
+    async def task(self):
+        with metrics.span('JobMonitor.task'):
+            return await self.run_task()
+
+    async def run_task(self):
+        # the cache is shared with the other monitors, it is only dropped after changing the queue
+        # (kills, releases, resubmissions), otherwise the snapshot expires by itself
+        self.unreachable = False
+        if self.glob:
+            # the node of the directory comes from the index, built from the global queue
+            await check_node(self.cache, self.cwd)
+        await self.cache.fetch(self.glob, self.user, self.constraint, self.attributes)
+        with metrics.span('JobMonitor.check_queue'):
+            if not await asyncio.to_thread(self.check_queue):
+                self.unreachable = True
+                return False
+        with metrics.span('JobMonitor.kill_long'):
+            killer = await find_long(self.days, self.hours, local=True, cache=self.cache, cwd=self.cwd,
+                                     percentile=self.percentile, history=self.history)
+            if killer.bad_id_list:
+                await kill_bad_job(killer)
+        with metrics.span('JobMonitor.check_missing'):
+            await asyncio.to_thread(self.check_missing)
+        if self.count_missing < 5:
+            if self.count_all == 0:
+                if self.tracker is not None and self.tracker.bad:
+                    print('Resubmitting jobs with bad outputs...')
+                    with metrics.span('JobMonitor.resubmit'):
+                        await self.resubmit()
+                    return False
+                await asyncio.to_thread(self.email_notification)
+                return True
+        elif self.count_all == 0:
+            print('No jobs found, resubmitting...')
+            with metrics.span('JobMonitor.resubmit'):
+                await self.resubmit()
+        elif self.count_missing > 20 * self.count_all:
+            print('Too many missing files, kill and resubmit remaining jobs')
+            with metrics.span('JobMonitor.resubmit'):
+                await kill_bad_job(await find_long(0, 0, local=True, cache=self.cache, cwd=self.cwd,
+                                                   history=self.history))
+                await self.resubmit()
+        return False
+
+    async def resubmit(self):
+        if self.tracker is None:
+            await asyncio.to_thread(JobMonitor.resubmit, self)
+            return
+        engine = ResubmitEngine(self.missing_jobs, self.cwd, kill=False)
+        await resubmit_jobs(engine)
+        self.cache.invalidate()
+        print(engine.summary())
+
+    async def watch(self):
+        """
+        Check until all jobs are done, waiting as long as the PollScheduler says in between
+        """
+        print(f'Watching {self.cwd} from node {self.node}...')
+        while not await self.task():
+            delay = self.poller.failed() if self.unreachable else self.poller.next_interval()
+            print(f'{self.cwd}: check again in {delay / 60:.0f} minutes')
+            self.next_check = time.time() + delay
+            self.sleeper = asyncio.ensure_future(asyncio.sleep(delay))
+            try:
+                await asyncio.wait({self.sleeper})
+            finally:
+                self.sleeper.cancel()
+            self.sleeper = None
+        self.done = True
+        self.next_check = None
+
+    def check_now(self):
+        """
+        Cut the current wait short
+        """
+        if self.sleeper is not None:
+            self.sleeper.cancel()
+
+    def status(self):
+        """
+        :return: dictionary with the latest numbers of this monitor
+        """
+        return {'dir': self.cwd, 'node': self.node, 'jobs': self.count_all, 'missing': self.count_missing,
+                'unreachable': self.unreachable, 'done': self.done, 'next_check': self.next_check,
+                'eta': self.poller.eta()}
+
+    def start(self, status_path=None):
+        """
+        Start monitoring, press Ctrl+\\ to check now
+        :param status_path: Unix socket answering the status of the monitor, if given
+        """
+        start([self], status_path)
+
+
+async def serve_status(monitors, path):
+    """
+    Answer every connection to a Unix socket with the status of the monitors (one JSON line)
+    :param monitors: the AsyncJobMonitors
+    :param path: path of the socket
+    :return: the asyncio server
+    """
+    async def answer(reader, writer):
+        writer.write(json.dumps([monitor.status() for monitor in monitors]).encode() + b'\n')
+        await writer.drain()
+        writer.close()
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(answer, path)
+    os.chmod(path, 0o600)
+    return server
+
+
+async def watch_all(monitors, status_path=None):
+    """
+    Watch several directories in one event loop until all are done, Ctrl+\\ checks all of them now
+    :param monitors: the AsyncJobMonitors
+    :param status_path: Unix socket answering the status of the monitors, if given
+    """
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGQUIT, lambda: [monitor.check_now() for monitor in monitors])
+    server = await serve_status(monitors, status_path) if status_path else None
+    try:
+        await asyncio.gather(*(monitor.watch() for monitor in monitors))
+    finally:
+        loop.remove_signal_handler(signal.SIGQUIT)
+        if server is not None:
+            server.close()
+            os.remove(status_path)
+
+
+def start(monitors, status_path=None):
+    """
+    Run watch_all() in a new event loop
+    """
+    asyncio.run(watch_all(monitors, status_path))
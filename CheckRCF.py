@@ -1,25 +1,65 @@
 import sys
 import os
+import select
+import shlex
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from fabric import Connection
 from invoke import Responder
-from pynput.keyboard import Key, Controller
 
 
 class RCFInterface:
+    """
+    Remote execution on RCF nodes over persistent SSH connections. One connection is opened per node
+    (through the gateway $RCFSSH, which is itself only connected once) and kept open, and every command
+    runs on its own channel of that connection, so there is no new handshake per command.
+    To run everything RCFNavigator does on a node from your own machine:
+        RCFNavigator.remote = RCFInterface()
+        print(NodeChecker().get_node())
+    or on several nodes at once:
+        RCFInterface().run_many('condor_q -totals', ['6006', '6015'])
+    Nodes are given by number (rcas6015) or by host name, e.g. 'localhost' with gateway=None for testing.
+    """
     host = os.environ.get('RCFSSH')
     username = os.environ.get('RCFUSER')
     key_dir = os.environ.get('RCFKEYDIR')
     password = os.environ.get('RCFPWD')
     node = "6015"
+    # maximum number of commands running at the same time on one node
+    channels = 8
+    # longest sleep while a command says nothing, in case its exit status comes without waking us up
+    wakeup = 1.0
+    # seconds between TERM and KILL of a command that timed out, and the exit codes of timeout(1) then
+    kill_after = 5
+    timeout_codes = (124, 137)
 
-    def __init__(self):
-        self.connection = Connection(self.host,
-                                     user=self.username)
-        # connect_kwargs={"key_filename": self.key_dir})
+    def __init__(self, node=None, gateway=True):
+        """
+        :param node: default node of run()
+        :param gateway: go through $RCFSSH, otherwise connect to the nodes directly
+        """
+        self.node = node or self.node
+        self.connect_kwargs = {"key_filename": self.key_dir} if self.key_dir else {}
+        self.connection = Connection(self.host, user=self.username, connect_kwargs=self.connect_kwargs) \
+            if gateway and self.host else None
+        self.connections = {}
+        self.semaphores = {}
+        # self.lock guards the dictionaries, connecting is done under the lock of the node (and of the gateway),
+        # so a slow or unreachable node does not hold up the others
+        self.lock = threading.Lock()
+        self.node_locks = {}
+        self.gateway_lock = threading.Lock()
 
     def __del__(self):
-        self.connection.close()
+        self.close()
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+        if self.connection is not None:
+            self.connection.close()
 
     def login(self, _node):
         password = Responder(pattern='{}@rcas{}\'s password'.format(self.username, _node),
@@ -27,16 +67,110 @@ class RCFInterface:
         self.connection.run("rterm -i rcas{}".format(_node), pty=True, watchers=[password])
         # self.connection = self.connection.create_session()
 
+    def node_connection(self, node):
+        """
+        The open connection to a node, connecting the first time
+        :param node: node number or host name
+        :return: (fabric connection, semaphore limiting its channels)
+        """
+        node = str(node)
+        with self.lock:
+            if node not in self.connections:
+                host = f'rcas{node}' if node.isdigit() else node
+                self.connections[node] = Connection(host, user=self.username, gateway=self.connection,
+                                                    connect_kwargs=self.connect_kwargs)
+                self.semaphores[node] = threading.BoundedSemaphore(self.channels)
+                self.node_locks[node] = threading.Lock()
+            connection, semaphore, lock = self.connections[node], self.semaphores[node], self.node_locks[node]
+        with lock:
+            if not connection.is_connected:
+                if self.connection is not None:
+                    # all nodes go through the gateway, it is connected once
+                    with self.gateway_lock:
+                        if not self.connection.is_connected:
+                            self.connection.open()
+                connection.open()
+                # keep idle connections alive through firewalls
+                connection.transport.set_keepalive(30)
+        return connection, semaphore
 
-def main():
-    node = "6015"
-    mysession = RCFInterface()
-    mysession.login(node)
-    time.sleep(5)
+    def run(self, command, node=None, timeout=None):
+        """
+        Run a command on a node over a new channel of the persistent connection
+        :param command: shell command string
+        :param node: node number or host name, default is the node given at construction
+        :param timeout: seconds before giving up on the command, None to wait forever.
+                        The command is then run by timeout(1) on the node, so it is killed there as well
+                        (closing the channel would leave it running, and a pty would mix std error into std output)
+        :return: (exit code, std output, std error), exit code -1 on timeout
+        """
+        connection, semaphore = self.node_connection(node or self.node)
+        deadline = None
+        if timeout is not None:
+            command = shlex.join(['timeout', '-k', str(self.kill_after), f'{timeout:g}', '/bin/sh', '-c', command])
+            # only if the node does not answer any more, normally timeout(1) ends the command first
+            deadline = time.monotonic() + timeout + self.kill_after + 5
+        out, err = [], []
+        with semaphore:
+            channel = connection.transport.open_session(timeout=timeout)
+            try:
+                channel.exec_command(command)
+                # read both streams as they come, so neither can fill up and block the other
+                while True:
+                    if channel.recv_ready():
+                        out.append(channel.recv(65536))
+                    elif channel.recv_stderr_ready():
+                        err.append(channel.recv_stderr(65536))
+                    elif channel.exit_status_ready():
+                        break
+                    elif deadline is not None and time.monotonic() > deadline:
+                        err.append(f'\nTimed out after {timeout} s\n'.encode())
+                        return -1, b''.join(out), b''.join(err)
+                    else:
+                        # the channel is readable when either stream has data or it is closed
+                        wait = self.wakeup
+                        if deadline is not None:
+                            wait = max(min(wait, deadline - time.monotonic()), 0)
+                        select.select([channel], [], [], wait)
+                code = channel.recv_exit_status()
+                if timeout is not None and code in self.timeout_codes:
+                    err.append(f'\nTimed out after {timeout} s\n'.encode())
+                    return -1, b''.join(out), b''.join(err)
+                return code, b''.join(out), b''.join(err)
+            finally:
+                channel.close()
 
-    command = 'cd /star/data01/pwg/xiatong/git\n'
-    keyboard = Controller()
-    keyboard.type(command)
+    def run_many(self, command, nodes, timeout=None):
+        """
+        Run the same command on several nodes at the same time
+        :param command: shell command string
+        :param nodes: list of node numbers or host names
+        :param timeout: seconds before giving up on each node
+        :return: dictionary of node -> (exit code, std output, std error), for a node that could not be
+                 reached (-1, b'', the error)
+        """
+        def run(node):
+            # one node failing must not cost the answers of the others
+            try:
+                return self.run(command, node, timeout)
+            except Exception as error:
+                return -1, b'', f'{type(error).__name__}: {error}\n'.encode()
+        with ThreadPoolExecutor(max_workers=len(nodes) or 1) as pool:
+            return dict(zip(nodes, pool.map(run, nodes)))
+
+
+def main():
+    node = sys.argv[1] if len(sys.argv) > 1 else RCFInterface.node
+    command = ' '.join(sys.argv[2:]) or 'hostname'
+    mysession = RCFInterface(node)
+    start = time.monotonic()
+    code, out, err = mysession.run(command)
+    print(out.decode('utf-8', 'replace'), end='')
+    print(err.decode('utf-8', 'replace'), end='', file=sys.stderr)
+    print(f'exit code {code}, {time.monotonic() - start:.2f} s (including connecting)', file=sys.stderr)
+    start = time.monotonic()
+    mysession.run(command)
+    print(f'again over the same connection: {time.monotonic() - start:.2f} s', file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,14 @@
 import tkinter as tk
 from tkinter import filedialog
 import pysftp
+import contextlib
 import os
+import queue
+import shlex
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 def main():
@@ -24,6 +31,14 @@ class FileChecker:
     dim = '720x360'
     path_width = 80
     num_width = 10
+    # ms between automatic checks, and between looks at the results of a running check
+    update_interval = 20000
+    poll_interval = 100
+
+    # for get/put
+    transfer_workers = 4
+    chunk_size = 1 << 20
+    progress_interval = 500
 
     def __init__(self):
         # set up connection
@@ -35,7 +50,16 @@ class FileChecker:
         self.window.title("RCF File Counter")
         self.window.geometry(self.dim)
 
-        # set up file number checking
+        # set up file number checking, counting runs in the background with one sftp channel per worker
+        self.pool = ThreadPoolExecutor(max_workers=len(self.dirs))
+        self.worker = threading.local()
+        self.worker_sftps = []
+        self.results = queue.Queue()
+        self.pending = 0
+        self.next_check = None
+        # path -> (mtime, number of files) of the last count, and whether counting over exec works
+        self.counts = {}
+        self.exec_ok = True
         self.dir_vars = []
         self.num_vars = []
         self.bool_vars = []
@@ -48,12 +72,20 @@ class FileChecker:
         self.ldir_var = tk.StringVar()
         self.ldir_var.set(self.local_dir)
         self.move_status = tk.StringVar()
+        self.transfer_pool = ThreadPoolExecutor(max_workers=self.transfer_workers)
+        self.transfer_lock = threading.Lock()
+        self.transfer = None
         self.move_module(len(self.dirs))
 
         self.window.mainloop()
 
     def __del__(self):
-        self.sftp.close()
+        self.pool.shutdown(wait=False)
+        self.transfer_pool.shutdown(wait=False)
+        for sftp in self.worker_sftps:
+            sftp.close()
+        if self.sftp is not None:
+            self.sftp.close()
 
     def set_var(self):
         # for file number checking
@@ -71,45 +103,236 @@ class FileChecker:
             self.bool_vars.append(bool_var)
 
     def get_numfile(self):
+        # a check is still running, the results will come in and schedule the next one
+        if self.pending:
+            return
+        if self.next_check is not None:
+            self.window.after_cancel(self.next_check)
+            self.next_check = None
+        # exec may have failed for a passing reason, every check tries it again
+        self.exec_ok = True
         for i in range(len(self.dir_vars)):
             if self.bool_vars[i].get():
                 self.num_vars[i].set('Checking')
-                self.window.update()
-                with self.sftp.cd(self.dir_vars[i].get()):
-                    self.num_vars[i].set(str(len(self.sftp.listdir())))
-                self.window.update()
-            else:
-                continue
-
-        # if you want auto update, uncomment below
-        self.window.after(20000, self.get_numfile)
-
-    def get_file(self):
-        self.move_status.set('Moving ...')
-        self.window.update()
-
-        # remote dir has to be a file, will implement get_d or get_r in future if needed
-        if os.path.isdir(self.ldir_var.get()):
-            filename = find_filename(self.rdir_var.get())
-            if self.ldir_var.get().endswith('/'):
-                self.sftp.get(self.rdir_var.get(), self.ldir_var.get() + filename)
-            else:
-                self.sftp.get(self.rdir_var.get(), self.ldir_var.get() + '/' + filename)
+                self.pending += 1
+                self.pool.submit(self.count_files, i, self.dir_vars[i].get())
+        self.collect_numfile()
+
+    def worker_sftp(self):
+        # each worker thread gets its own connection, sftp channels are not thread-safe
+        if not hasattr(self.worker, 'sftp'):
+            self.worker.sftp = pysftp.Connection(self.host, username=self.username,
+                                                 private_key=self.key_dir, private_key_pass=self.key_pass)
+            self.worker_sftps.append(self.worker.sftp)
+        return self.worker.sftp
+
+    def drop_worker_sftp(self):
+        # after an error, the next use of this thread connects again
+        sftp = getattr(self.worker, 'sftp', None)
+        if sftp is None:
+            return
+        del self.worker.sftp
+        self.worker_sftps.remove(sftp)
+        # closing a broken connection may fail as well
+        with contextlib.suppress(Exception):
+            sftp.close()
+
+    def count_files(self, index, path):
+        # runs on a worker thread, never touch tk from here
+        try:
+            sftp = self.worker_sftp()
+            # adding or removing files changes the directory mtime, so an unchanged mtime means
+            # an unchanged count (up to files landing in the same second as the last count)
+            mtime = sftp.stat(path).st_mtime
+            if path not in self.counts or self.counts[path][0] != mtime:
+                self.counts[path] = (mtime, self.remote_count(sftp, path))
+            self.results.put((index, str(self.counts[path][1])))
+        except Exception as e:
+            # reconnect on the next check
+            self.drop_worker_sftp()
+            self.results.put((index, f'Error: {e}'))
+
+    def remote_count(self, sftp, path):
+        # count on the remote side in one round trip instead of transferring every file name,
+        # fall back to listdir if the server does not allow exec (or the answer makes no sense),
+        # for the rest of this check
+        if self.exec_ok:
+            try:
+                output = sftp.execute(f'find {shlex.quote(path)} -mindepth 1 -maxdepth 1 -printf . | wc -c')
+                # the count is the first line, whatever else comes back (e.g. warnings of find)
+                return int(output[0].strip())
+            except Exception:
+                self.exec_ok = False
+        return len(sftp.listdir(path))
+
+    def collect_numfile(self):
+        # runs on the tk main thread, show whatever the workers have finished
+        while True:
+            try:
+                index, num = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.num_vars[index].set(num)
+            self.pending -= 1
+        if self.pending:
+            self.window.after(self.poll_interval, self.collect_numfile)
         else:
-            self.sftp.get(self.rdir_var.get(), self.ldir_var.get())
+            # if you do not want auto update, comment below
+            self.next_check = self.window.after(self.update_interval, self.get_numfile)
 
-        self.move_status.set('Done!')
-        self.window.update()
+    def get_file(self):
+        # remote path can be a file or a directory, directories are copied recursively
+        self.start_transfer('get', self.rdir_var.get(), self.ldir_var.get())
 
     def put_file(self):
+        # local path can be a file or a directory, directories are copied recursively
+        self.start_transfer('put', self.ldir_var.get(), self.rdir_var.get())
+
+    def start_transfer(self, direction, src, dst):
+        # one transfer at a time, planned on a background thread and run on the transfer pool
+        if self.transfer is not None:
+            return
+        self.transfer = {'files': 0, 'done': 0, 'skipped': 0, 'failed': 0, 'bytes': 0,
+                         'start': time.monotonic(), 'finished': False, 'error': None}
         self.move_status.set('Moving ...')
-        self.window.update()
-
-        with self.sftp.cd(pure_path(self.rdir_var.get())):
-            self.sftp.put(self.ldir_var.get())
-
-        self.move_status.set('Done!')
-        self.window.update()
+        threading.Thread(target=self.run_transfer, args=(direction, src, dst), daemon=True).start()
+        self.show_progress()
+
+    def run_transfer(self, direction, src, dst):
+        # transfers run one at a time, so the planning uses the main connection
+        try:
+            if self.sftp is None:
+                self.sftp = pysftp.Connection(self.host, username=self.username,
+                                              private_key=self.key_dir, private_key_pass=self.key_pass)
+            pairs = self.plan_get(self.sftp, src, dst) if direction == 'get' else self.plan_put(self.sftp, src, dst)
+            self.transfer['files'] = len(pairs)
+            futures = [self.transfer_pool.submit(self.transfer_file, direction, *pair) for pair in pairs]
+            for future in futures:
+                future.result()
+        except Exception as e:
+            # reconnect on the next transfer
+            if self.sftp is not None:
+                self.sftp.close()
+                self.sftp = None
+            self.transfer['error'] = str(e)
+        self.transfer['finished'] = True
+
+    def plan_get(self, sftp, src, dst):
+        # list of (remote file, local file), creating the local directories on the way
+        src = src.rstrip('/')
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, find_filename(src))
+        if not sftp.isdir(src):
+            return [(src, dst)]
+        pairs = []
+        folders = [(src, dst)]
+        while folders:
+            remote, local = folders.pop()
+            os.makedirs(local, exist_ok=True)
+            for attr in sftp.listdir_attr(remote):
+                pair = (remote + '/' + attr.filename, os.path.join(local, attr.filename))
+                if stat.S_ISDIR(attr.st_mode):
+                    folders.append(pair)
+                else:
+                    pairs.append(pair)
+        return pairs
+
+    def plan_put(self, sftp, src, dst):
+        # list of (local file, remote file), creating the remote directories on the way
+        src = src.rstrip('/')
+        if not os.path.isdir(src):
+            # like before, a remote file path means its directory
+            folder = dst if sftp.isdir(dst) else pure_path(dst)
+            return [(src, folder + '/' + os.path.basename(src))]
+        if sftp.isdir(dst):
+            dst = dst.rstrip('/') + '/' + os.path.basename(src)
+        pairs = []
+        folders = [(src, dst)]
+        while folders:
+            local, remote = folders.pop()
+            sftp.makedirs(remote)
+            with os.scandir(local) as entries:
+                for entry in entries:
+                    pair = (entry.path, remote + '/' + entry.name)
+                    if entry.is_dir():
+                        folders.append(pair)
+                    else:
+                        pairs.append(pair)
+        return pairs
+
+    def transfer_file(self, direction, src, dst):
+        # runs on a transfer worker. Files whose size and mtime already match are skipped,
+        # the rest goes to a .part file first, so an interrupted transfer is resumed from where it stopped.
+        # The .part name has the size and mtime of the source, a source that changed since starts over
+        try:
+            sftp = self.worker_sftp()
+            if direction == 'get':
+                attr = sftp.stat(src)
+                size, mtime = attr.st_size, int(attr.st_mtime)
+                if os.path.exists(dst) and (os.path.getsize(dst), int(os.path.getmtime(dst))) == (size, mtime):
+                    self.count_transfer('skipped')
+                    return
+                part = f'{dst}.{size}.{mtime}.part'
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                if offset > size:
+                    offset = 0
+                with sftp.open(src, 'rb') as remote, open(part, 'ab' if offset else 'wb') as local:
+                    remote.seek(offset)
+                    # pipelined reads, all requests are sent before waiting for the answers
+                    remote.prefetch(size)
+                    while data := remote.read(self.chunk_size):
+                        local.write(data)
+                        self.count_transfer('bytes', len(data))
+                os.utime(part, (mtime, mtime))
+                os.replace(part, dst)
+            else:
+                size, mtime = os.path.getsize(src), int(os.path.getmtime(src))
+                if sftp.exists(dst):
+                    attr = sftp.stat(dst)
+                    if (attr.st_size, int(attr.st_mtime)) == (size, mtime):
+                        self.count_transfer('skipped')
+                        return
+                part = f'{dst}.{size}.{mtime}.part'
+                offset = sftp.stat(part).st_size if sftp.exists(part) else 0
+                if offset > size:
+                    offset = 0
+                with open(src, 'rb') as local, sftp.open(part, 'ab' if offset else 'wb') as remote:
+                    # pipelined writes, do not wait for each write to be acknowledged
+                    remote.set_pipelined(True)
+                    local.seek(offset)
+                    while data := local.read(self.chunk_size):
+                        remote.write(data)
+                        self.count_transfer('bytes', len(data))
+                sftp.sftp_client.utime(part, (mtime, mtime))
+                sftp.sftp_client.posix_rename(part, dst)
+            self.count_transfer('done')
+        except Exception:
+            # reconnect on the next file
+            self.drop_worker_sftp()
+            self.count_transfer('failed')
+
+    def count_transfer(self, key, amount=1):
+        with self.transfer_lock:
+            self.transfer[key] += amount
+
+    def show_progress(self):
+        # runs on the tk main thread
+        transfer = self.transfer
+        elapsed = max(time.monotonic() - transfer['start'], 1e-6)
+        finished = transfer['done'] + transfer['skipped'] + transfer['failed']
+        status = (f'{finished}/{transfer["files"]} files, {transfer["bytes"] / elapsed / 1e6:.1f} MB/s'
+                  + (f', {transfer["skipped"]} skipped' if transfer['skipped'] else '')
+                  + (f', {transfer["failed"]} failed' if transfer['failed'] else ''))
+        if transfer['error']:
+            self.move_status.set(f'Error: {transfer["error"]}')
+        elif transfer['finished']:
+            self.move_status.set('Done! ' + status)
+        else:
+            self.move_status.set(status)
+        if transfer['finished']:
+            self.transfer = None
+        else:
+            self.window.after(self.progress_interval, self.show_progress)
 
     def browse(self):
         # Allow user to select a directory and store it in global var
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import numpy as np
+from RCFNavigator import JobStatus, cache_dir
+
+
+class JobHistory:
+    """
+    On-disk (SQLite) history of the jobs of each directory, used to learn how long jobs normally take.
+    Every record() stores the latest snapshot of a directory and a summary row; running jobs that
+    disappeared since the previous snapshot are counted as completed with their last seen run time,
+    unless we killed them ourselves (record_kills). Only the schedds the snapshot covers (asked and answered,
+    see JobTable.covered) are compared, so local and global snapshots can be mixed. The statistics are computed with NumPy, e.g.
+        history = JobHistory()
+        history.record(table, table.in_dir(cwd), cwd)
+        print(history.stats(cwd))
+        print(history.threshold(cwd, percentile=95))
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS live (dir TEXT, schedd TEXT, job TEXT, sched TEXT, status INTEGER,
+                                         run_time INTEGER, PRIMARY KEY (dir, schedd, job));
+        CREATE TABLE IF NOT EXISTS snapshots (time REAL, dir TEXT, running INTEGER, idle INTEGER, held INTEGER);
+        CREATE TABLE IF NOT EXISTS completions (time REAL, dir TEXT, job TEXT, sched TEXT, run_time INTEGER);
+        CREATE TABLE IF NOT EXISTS kills (dir TEXT, job TEXT, PRIMARY KEY (dir, job));
+        CREATE INDEX IF NOT EXISTS completions_dir ON completions (dir, time);
+        CREATE INDEX IF NOT EXISTS snapshots_dir ON snapshots (dir, time);
+    '''
+
+    def __init__(self, path=None):
+        """
+        :param path: the database file, default is history.sqlite in the cache directory
+        """
+        self.path = path or os.path.join(cache_dir, 'history.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.connect() as db:
+            db.executescript(self.schema)
+
+    def connect(self):
+        """
+        A new connection, so the history can be used from several threads (e.g. MultiMonitor)
+        :return: the sqlite connection
+        """
+        db = sqlite3.connect(self.path, timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def record(self, table, rows, cwd):
+        """
+        Store a snapshot of one directory and detect the jobs that completed since the last one
+        :param table: the JobTable
+        :param rows: rows of the table that belong to the directory
+        :param cwd: the directory
+        :return: number of completions found
+        """
+        now = table.time
+        nodes = table.covered()
+        current = {}
+        for i in rows:
+            if table.status[i] != JobStatus.REMOVED:
+                current[(table.schedd[i], table.job_id(i))] = (table.sched_name(i), table.status[i],
+                                                               table.run_time(i, now))
+        with self.connect() as db:
+            previous = db.execute('SELECT schedd, job, sched, run_time FROM live WHERE dir = ? AND status = ?',
+                                  (cwd, JobStatus.RUNNING)).fetchall()
+            killed = {tuple(key.split('#', 1)) for key, in db.execute('SELECT job FROM kills WHERE dir = ?', (cwd,))}
+            # also the schedds where none of the jobs are left, that is where the last ones completed
+            known = {schedd for schedd, in db.execute('SELECT DISTINCT schedd FROM live WHERE dir = ?', (cwd,))}
+            covered = {schedd for schedd in known | {schedd for schedd, _ in killed} | set(table.schedd)
+                       if schedd.split('.')[0] in nodes}
+            completed = [(now, cwd, job, sched, run_time) for schedd, job, sched, run_time in previous
+                         if schedd in covered and (schedd, job) not in current and (schedd, job) not in killed]
+            db.executemany('INSERT INTO completions VALUES (?, ?, ?, ?, ?)', completed)
+            for schedd in covered:
+                db.execute('DELETE FROM live WHERE dir = ? AND schedd = ?', (cwd, schedd))
+                db.execute('DELETE FROM kills WHERE dir = ? AND job LIKE ?', (cwd, schedd + '#%'))
+            db.executemany('INSERT INTO live VALUES (?, ?, ?, ?, ?, ?)',
+                           [(cwd,) + key + values for key, values in current.items()])
+            statuses = [status for _, status, _ in current.values()]
+            db.execute('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)',
+                       (now, cwd, statuses.count(JobStatus.RUNNING), statuses.count(JobStatus.IDLE),
+                        statuses.count(JobStatus.HELD)))
+        return len(completed)
+
+    def record_kills(self, cwd, jobs):
+        """
+        Remember jobs we killed, so their disappearance is not taken as a completion
+        :param cwd: the directory
+        :param jobs: list of (schedd, job id) pairs
+        """
+        with self.connect() as db:
+            db.executemany('INSERT OR IGNORE INTO kills VALUES (?, ?)',
+                           [(cwd, f'{schedd}#{job_id}') for schedd, job_id in jobs])
+
+    def run_times(self, cwd, since=None):
+        """
+        :param cwd: the directory
+        :param since: only completions after this time stamp
+        :return: NumPy array of the run times (s) of the completed jobs
+        """
+        with self.connect() as db:
+            values = db.execute('SELECT run_time FROM completions WHERE dir = ? AND time >= ?',
+                                (cwd, since or 0)).fetchall()
+        return np.fromiter((value for value, in values), dtype=np.int64, count=len(values))
+
+    def stats(self, cwd, since=None):
+        """
+        Run time statistics of the completed jobs of a directory
+        :param cwd: the directory
+        :param since: only completions after this time stamp
+        :return: dictionary with count, mean, std, median, p90, p95, p99 and max in seconds
+        """
+        run_times = self.run_times(cwd, since)
+        if run_times.size == 0:
+            return {'count': 0}
+        p50, p90, p95, p99 = np.percentile(run_times, [50, 90, 95, 99])
+        return {'count': int(run_times.size), 'mean': float(run_times.mean()), 'std': float(run_times.std()),
+                'median': float(p50), 'p90': float(p90), 'p95': float(p95), 'p99': float(p99),
+                'max': int(run_times.max())}
+
+    def threshold(self, cwd, percentile=95, factor=1.5, min_samples=20):
+        """
+        Run time beyond which a job of this directory is a straggler
+        :param cwd: the directory
+        :param percentile: percentile of the completed run times
+        :param factor: the threshold is this times the percentile
+        :param min_samples: below this many completions there is not enough to go on
+        :return: threshold in seconds, None if there are not enough completions
+        """
+        run_times = self.run_times(cwd)
+        if run_times.size < min_samples:
+            return None
+        return float(np.percentile(run_times, percentile)) * factor
+
+    def progress(self, cwd, limit=20):
+        """
+        Recent snapshot summaries of a directory, oldest first
+        :param cwd: the directory
+        :param limit: number of snapshots
+        :return: NumPy array with columns time, running, idle, held
+        """
+        with self.connect() as db:
+            values = db.execute('SELECT time, running, idle, held FROM snapshots WHERE dir = ? '
+                                'ORDER BY time DESC LIMIT ?', (cwd, limit)).fetchall()
+        return np.array(values[::-1], dtype=float).reshape(-1, 4)
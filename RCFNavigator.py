@@ -3,11 +3,198 @@
 import queue
 import subprocess as sp
 import os
+import re
+import shutil
+import glob
+import json
+import mmap
+import zlib
+import random
+import shlex
+import contextlib
+import io
+import sys
 import time
+from array import array
+from collections import deque
 import smtplib
 from typing import Any
 import signal
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class CommandMetrics:
+    """
+    Opt-in instrumentation of every command run through RCFNavigator:
+    the kind of command, wall time, output size, exit code and known error signatures in std error.
+    Each command is appended to a JSONL file, and histograms per kind are written to a Prometheus
+    text-format file that a node-exporter textfile collector can pick up. Enable it with
+        metrics.enable(jsonl='/path/rcfnav.jsonl', prom='/path/rcfnav.prom')
+    or by setting $RCFNAV_METRICS to a path prefix (.jsonl and .prom are appended).
+    Every process (the CLI, the daemon, several monitors) keeps its own counts, so each writes its own
+    Prometheus file with the program and pid in the name, e.g. /path/rcfnav.rcfnavd.1234.prom, and as
+    labels. Files of processes that are gone are left for the last scrape, clean them up e.g. with
+        find /path -name 'rcfnav.*.prom' -mmin +60 -delete
+    Work that is not a command can be timed as well:
+        with metrics.span('check_missing'):
+            ...
+    """
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    signatures = ('Failed to fetch ads', 'Timed out', 'Connection refused', 'Permission denied',
+                  'not found', "Couldn't find")
+
+    def __init__(self):
+        self.enabled = False
+        self.jsonl = None
+        self.prom = None
+        self.lock = threading.Lock()
+        # kind -> [bucket counts..., sum, count, output bytes, failures], and (kind, signature) -> count
+        self.histograms = {}
+        self.errors = {}
+
+    def enable(self, jsonl=None, prom=None):
+        """
+        :param jsonl: file to append one json record per command to
+        :param prom: Prometheus text-format file to keep up to date, the program and pid are put before
+                     the extension (see prom_path)
+        """
+        self.enabled = True
+        self.jsonl = jsonl
+        self.prom = prom
+
+    @staticmethod
+    def kind(command):
+        """
+        Short name of a command, e.g. condor_q, or the script name when it is run by an interpreter
+        :param command: shell string or argument list
+        """
+        args = command.split() if isinstance(command, str) else list(command)
+        if not args:
+            return ''
+        kind = os.path.basename(args[0])
+        if kind.startswith('python') and len(args) > 1:
+            kind = os.path.basename(args[1])
+        return kind
+
+    def record(self, command, wall, out_size, exit_code, err=b''):
+        """
+        Record one command
+        :param command: shell string or argument list
+        :param wall: wall time in seconds
+        :param out_size: bytes of std output
+        :param exit_code: exit code of the command
+        :param err: std error of the command
+        """
+        if not self.enabled:
+            return
+        kind = self.kind(command)
+        err = err.decode('utf-8', 'replace') if isinstance(err, bytes) else err
+        found = [signature for signature in self.signatures if signature in err]
+        with self.lock:
+            histogram = self.histograms.setdefault(kind, [0] * (len(self.buckets) + 4))
+            for index, bound in enumerate(self.buckets):
+                if wall <= bound:
+                    histogram[index] += 1
+            histogram[-4] += wall
+            histogram[-3] += 1
+            histogram[-2] += out_size
+            histogram[-1] += exit_code != 0
+            for signature in found:
+                self.errors[(kind, signature)] = self.errors.get((kind, signature), 0) + 1
+            if self.jsonl:
+                with open(self.jsonl, 'a') as f:
+                    f.write(json.dumps({'time': time.time(), 'kind': kind, 'wall': round(wall, 6),
+                                        'out_bytes': out_size, 'exit_code': exit_code, 'errors': found}) + '\n')
+            if self.prom:
+                self.write_prom()
+
+    @contextlib.contextmanager
+    def span(self, kind):
+        """
+        Time a block of work that is not a command, recorded like a command of that kind
+        :param kind: name to record it under
+        """
+        start = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record([kind], time.monotonic() - start, 0, int(failed))
+
+    @staticmethod
+    def program():
+        """
+        :return: name of the running script without extension, e.g. rcfnavd, python for python -c or the shell
+        """
+        script = sys.argv[0] if sys.argv and sys.argv[0] not in ('', '-c') else 'python'
+        return os.path.splitext(os.path.basename(script))[0]
+
+    def prom_path(self):
+        """
+        The Prometheus file of this process, taken at every write so forked workers get their own
+        :return: e.g. /path/rcfnav.rcfnavd.1234.prom for /path/rcfnav.prom
+        """
+        root, ext = os.path.splitext(self.prom)
+        return f'{root}.{self.program()}.{os.getpid()}{ext}'
+
+    def write_prom(self):
+        """
+        Write all histograms in Prometheus text format, through a temporary file
+        so the collector never reads half a file. Call with the lock held
+        """
+        # the files of all processes are read together, the series must not collide
+        process = f'program="{self.program()}",pid="{os.getpid()}"'
+        lines = ['# HELP rcfnav_command_seconds Wall time of commands run by RCFNavigator',
+                 '# TYPE rcfnav_command_seconds histogram']
+        for kind, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f'rcfnav_command_seconds_bucket{{{process},kind="{kind}",le="{bound}"}} {count}')
+            lines.append(f'rcfnav_command_seconds_bucket{{{process},kind="{kind}",le="+Inf"}} {histogram[-3]}')
+            lines.append(f'rcfnav_command_seconds_sum{{{process},kind="{kind}"}} {histogram[-4]:.6f}')
+            lines.append(f'rcfnav_command_seconds_count{{{process},kind="{kind}"}} {histogram[-3]}')
+        lines += ['# HELP rcfnav_command_output_bytes_total Bytes of std output of commands',
+                  '# TYPE rcfnav_command_output_bytes_total counter']
+        lines += [f'rcfnav_command_output_bytes_total{{{process},kind="{kind}"}} {histogram[-2]}'
+                  for kind, histogram in sorted(self.histograms.items())]
+        lines += ['# HELP rcfnav_command_failures_total Commands with a non-zero exit code',
+                  '# TYPE rcfnav_command_failures_total counter']
+        lines += [f'rcfnav_command_failures_total{{{process},kind="{kind}"}} {histogram[-1]}'
+                  for kind, histogram in sorted(self.histograms.items())]
+        lines += ['# HELP rcfnav_command_errors_total Known error signatures in std error of commands',
+                  '# TYPE rcfnav_command_errors_total counter']
+        lines += [f'rcfnav_command_errors_total{{{process},kind="{kind}",signature="{signature}"}} {count}'
+                  for (kind, signature), count in sorted(self.errors.items())]
+        path = self.prom_path()
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp, path)
+
+
+metrics = CommandMetrics()
+if os.environ.get('RCFNAV_METRICS'):
+    metrics.enable(jsonl=os.environ['RCFNAV_METRICS'] + '.jsonl', prom=os.environ['RCFNAV_METRICS'] + '.prom')
+
+
+def _kill(process):
+    """
+    Kill a process started in its own session together with everything it started
+    :param process: the Popen object
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _shell(command):
+    """
+    :param command: shell string or argument list
+    :return: the command as a shell string
+    """
+    return command if isinstance(command, str) else shlex.join(command)
 
 
 class RCFNavigator:
@@ -19,14 +206,43 @@ class RCFNavigator:
     This could be much more helpful if I figured out how to navigate RCF's 'rterm' terminal procedure.
     This should be doable in theory, but I am still not familiar enough with channeling displays to make it work.
     It also may be a platform-dependent thing. But if anyone figured out how to do it, please let me know.
+
+    Commands can also run on an RCF node from elsewhere, over the persistent SSH connections of
+    CheckRCF.RCFInterface (anything with run(command, timeout=...) -> (exit code, out, err) works):
+        RCFNavigator.remote = RCFInterface()
     """
-    def __init__(self, command):
+    # where commands are run when no remote is given, None for locally
+    remote = None
+
+    def __init__(self, command, timeout=None, remote=None):
         """
         Initializer for RCF Navigator
-        :param command: the command associated with the RCF query (i.e., condor_q, condor_rm)
+        :param command: the command associated with the RCF query (i.e., condor_q, condor_rm),
+                        either a shell string or an argument list (run without shell)
+        :param timeout: seconds to wait before killing the command, None to wait forever
+        :param remote: run the command through this remote interface instead of RCFNavigator.remote
         """
-        self.p = sp.Popen(command, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
-        self.out, self.err = self.p.communicate()
+        self.timed_out = False
+        start = time.monotonic()
+        remote = remote or self.remote
+        if remote is not None:
+            code, self.out, self.err = remote.run(_shell(command), timeout=timeout)
+            # stands in for the local process, only the return code is of interest
+            self.p = sp.CompletedProcess(command, code, self.out, self.err)
+            self.timed_out = code == -1
+            metrics.record(command, time.monotonic() - start, len(self.out), code, self.err)
+            return
+        # own process group, so that a timeout also kills whatever a shell command started
+        self.p = sp.Popen(command, shell=isinstance(command, str), stdout=sp.PIPE, stderr=sp.PIPE,
+                          start_new_session=True)
+        try:
+            self.out, self.err = self.p.communicate(timeout=timeout)
+        except sp.TimeoutExpired:
+            _kill(self.p)
+            self.out, self.err = self.p.communicate()
+            self.timed_out = True
+            self.err += f'\nTimed out after {timeout} s\n'.encode()
+        metrics.record(command, time.monotonic() - start, len(self.out), self.p.returncode, self.err)
 
     def get_process(self):
         """
@@ -67,41 +283,899 @@ class AutoBuffer(queue.Queue):
             self.get()
         self.put(element)
 
+class JobStatus:
+    """
+    Numeric JobStatus codes used by condor (the letters shown by the human-readable condor_q)
+    """
+    IDLE = 1            # I
+    RUNNING = 2         # R
+    REMOVED = 3         # X
+    COMPLETED = 4       # C
+    HELD = 5            # H
+    TRANSFERRING = 6    # >
+    SUSPENDED = 7       # S
+
+
+def _to_int(field):
+    """
+    Convert an autoformat field to int. Condor prints 'undefined' for missing attributes,
+    and some times (e.g. RemoteWallClockTime) come as floats
+    :param field: the field string
+    :return: the integer value, 0 if undefined
+    """
+    try:
+        return int(field)
+    except ValueError:
+        try:
+            return int(float(field))
+        except ValueError:
+            return 0
+
+
+def _in_dir(iwd, cmd, cwd):
+    """
+    Whether a job is related to a directory, i.e. submitted from it or with the script in it
+    :param iwd: Iwd of the job
+    :param cmd: Cmd of the job
+    :param cwd: the directory, with trailing '/'
+    """
+    return (iwd + '/').startswith(cwd) or cmd.startswith(cwd)
+
+
+class JobTable:
+    """
+    A compact, column-oriented table of condor jobs parsed from 'condor_q -af:t' output.
+    Numeric columns are stored in arrays and string columns in lists (with repeated strings interned),
+    so a queue of 100k jobs costs a few MB and every record is decoded exactly once.
+    Rows are addressed by index, e.g.
+        table = CondorQuery().table()
+        for i in table.in_dir(cwd):
+            print(table.job_id(i), table.node(i))
+    """
+    # the order here is the column order requested from condor_q, Args has to stay last
+    # since it is the only attribute that may contain spaces we do not control
+    attributes = ('ClusterId', 'ProcId', 'JobStatus', 'EnteredCurrentStatus', 'RemoteWallClockTime',
+                  'GlobalJobId', 'RemoteHost', 'Iwd', 'Cmd', 'HoldReasonCode', 'HoldReasonSubCode', 'RequestMemory',
+                  'HoldReason', 'Args')
+    columns = ('cluster', 'proc', 'status', 'entered', 'wall_clock', 'schedd', 'host', 'iwd', 'cmd',
+               'hold_code', 'hold_subcode', 'memory', 'hold_reason', 'args')
+    __slots__ = columns + ('error', 'unreachable', 'queried', 'time', 'complete')
+
+    def __init__(self):
+        self.cluster = array('l')
+        self.proc = array('l')
+        self.status = array('b')
+        self.entered = array('q')
+        self.wall_clock = array('q')
+        self.schedd = []
+        self.host = []
+        self.iwd = []
+        self.cmd = []
+        # only defined for held jobs, 0 and 'undefined' otherwise
+        self.hold_code = array('h')
+        self.hold_subcode = array('h')
+        self.memory = array('l')
+        self.hold_reason = []
+        self.args = []
+        # std error of the query, the schedds that did not answer and the time it was taken
+        self.error = ''
+        self.unreachable = []
+        self.time = time.time()
+        # the schedds that were asked, answered or not, empty if not known
+        self.queried = []
+        # all jobs of the user on the schedds that answered, False for the answer of a constraint
+        self.complete = True
+
+    @classmethod
+    def parse(cls, out, err=b'', attributes=None):
+        """
+        Parse the output of condor_q -af:t with the attributes above
+        :param out: std output of condor_q (bytes or str)
+        :param err: std error of condor_q (bytes or str)
+        :param attributes: the attributes that were asked for, in the order above, default is all of them.
+                           Columns of the others are filled with 0 and ''
+        :return: the job table
+        """
+        table = cls()
+        if isinstance(out, bytes):
+            out = out.decode('utf-8', 'replace')
+        if isinstance(err, bytes):
+            err = err.decode('utf-8', 'replace')
+        table.error = err
+        # e.g. -- Failed to fetch ads from: <130.199.1.1:9618?...> : rcas6006.rcf.bnl.gov
+        table.unreachable = [line.rsplit(' : ', 1)[-1].strip() for line in err.splitlines()
+                             if 'Failed to fetch ads' in line]
+        attributes = attributes or cls.attributes
+        n = len(attributes)
+        # schedd banners, blank lines and warnings do not have the right number of fields
+        rows = [fields for fields in (line.split('\t', n - 1) for line in out.splitlines()) if len(fields) == n]
+        if not rows:
+            return table
+        fields = dict(zip(attributes, zip(*rows)))
+        (cluster, proc, status, entered, wall_clock, global_id, host, iwd, cmd, hold_code, hold_subcode, memory,
+         hold_reason, args) = (fields.get(name) or ('',) * len(rows) for name in cls.attributes)
+        table.cluster = array('l', map(_to_int, cluster))
+        table.proc = array('l', map(_to_int, proc))
+        table.status = array('b', map(_to_int, status))
+        table.entered = array('q', map(_to_int, entered))
+        table.wall_clock = array('q', map(_to_int, wall_clock))
+        # GlobalJobId looks like rcas6006.rcf.bnl.gov#123.0#1700000000
+        table.schedd = [sys.intern(job.split('#', 1)[0]) for job in global_id]
+        table.host = list(map(sys.intern, host))
+        table.iwd = list(map(sys.intern, iwd))
+        table.cmd = list(cmd)
+        table.hold_code = array('h', map(_to_int, hold_code))
+        table.hold_subcode = array('h', map(_to_int, hold_subcode))
+        table.memory = array('l', map(_to_int, memory))
+        table.hold_reason = list(map(sys.intern, hold_reason))
+        table.args = list(args)
+        return table
+
+    def __len__(self):
+        return len(self.cluster)
+
+    def job_id(self, i):
+        """
+        :param i: row index
+        :return: the job id string, e.g. 123.4
+        """
+        return f'{self.cluster[i]}.{self.proc[i]}'
+
+    def node(self, i):
+        """
+        :param i: row index
+        :return: the short name of the schedd the job belongs to, e.g. rcas6006
+        """
+        return self.schedd[i].split('.')[0]
+
+    def sched_name(self, i):
+        """
+        The name of the star-submit script without extension, e.g. sched1234ABCD_12
+        :param i: row index
+        :return: the sched name
+        """
+        return os.path.splitext(os.path.basename(self.cmd[i]))[0]
+
+    def run_time(self, i, now=None):
+        """
+        Accumulated run time as shown in the RUN_TIME column of condor_q
+        :param i: row index
+        :param now: current time stamp, default is the time the table was taken
+        :return: run time in seconds
+        """
+        run_time = self.wall_clock[i]
+        if self.status[i] == JobStatus.RUNNING:
+            run_time += int((now or self.time) - self.entered[i])
+        return run_time
+
+    def in_dir(self, cwd):
+        """
+        Rows of jobs related to a directory, i.e. submitted from it or with the script in it
+        :param cwd: the directory, with trailing '/'
+        :return: list of row indices
+        """
+        return [i for i in range(len(self.cluster)) if _in_dir(self.iwd[i], self.cmd[i], cwd)]
+
+    def partition(self, dirs):
+        """
+        Split the rows by directory in one pass, like in_dir() for many directories at once
+        :param dirs: directories (with trailing '/')
+        :return: dictionary of directory -> list of row indices
+        """
+        parts = {cwd: [] for cwd in dirs}
+        for i in range(len(self.cluster)):
+            found = set()
+            for path in (self.iwd[i] + '/', os.path.dirname(self.cmd[i]) + '/'):
+                # the directory itself or any of its parents
+                while len(path) > 1:
+                    if path in parts:
+                        found.add(path)
+                    path = path[:path.rstrip('/').rfind('/') + 1]
+            for cwd in found:
+                parts[cwd].append(i)
+        return parts
+
+    def subset(self, rows):
+        """
+        A new table with only the given rows, e.g. the jobs of one directory or one schedd
+        :param rows: row indices
+        :return: the new job table, with the same error and time stamp, not complete any more
+        """
+        table = JobTable()
+        for name in self.columns:
+            column = getattr(self, name)
+            if isinstance(column, array):
+                setattr(table, name, array(column.typecode, [column[i] for i in rows]))
+            else:
+                setattr(table, name, [column[i] for i in rows])
+        table.error = self.error
+        table.unreachable = self.unreachable
+        table.queried = self.queried
+        table.time = self.time
+        table.complete = False
+        return table
+
+    def matching(self, constraint):
+        """
+        A new table with only the jobs matching a constraint, as if condor_q had been asked for them
+        :param constraint: the Constraint
+        :return: the new job table
+        """
+        return self.subset(constraint.rows(self))
+
+    @classmethod
+    def merge(cls, tables):
+        """
+        One table with the jobs of several, e.g. the answers of several schedds
+        :param tables: the job tables
+        :return: the new job table, with all errors and unreachable schedds, and the oldest time stamp
+        """
+        table = cls()
+        for name in cls.columns:
+            column = getattr(table, name)
+            for part in tables:
+                column.extend(getattr(part, name))
+        table.error = ''.join(part.error for part in tables)
+        table.unreachable = [name for part in tables for name in part.unreachable]
+        table.queried = [name for part in tables for name in part.queried]
+        if tables:
+            table.time = min(part.time for part in tables)
+        table.complete = all(part.complete for part in tables)
+        return table
+
+    def covered(self):
+        """
+        The schedds the table has all jobs of (subject to the constraint of the query): those that were asked
+        and answered, also when none of the jobs are left on them
+        :return: set of short schedd names, e.g. {'rcas6006'}
+        """
+        unreachable = {name.split('.')[0] for name in self.unreachable}
+        return {name.split('.')[0] for name in set(self.queried) | set(self.schedd)} - unreachable
+
+    def count_status(self, rows=None):
+        """
+        Count jobs by status
+        :param rows: row indices to count, default is all rows
+        :return: dictionary of JobStatus code -> number of jobs
+        """
+        counts = {}
+        for i in (range(len(self.cluster)) if rows is None else rows):
+            counts[self.status[i]] = counts.get(self.status[i], 0) + 1
+        return counts
+
+
+def _quote(string):
+    """
+    :param string: any string
+    :return: the string as a ClassAd string literal
+    """
+    return '"' + string.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class Constraint:
+    """
+    A condor constraint (ClassAd expression) for condor_q -constraint, so the schedd only sends the jobs we want
+    instead of the whole queue of the user. Every constraint also knows how to do the same test on a JobTable,
+    so a snapshot that is already there can answer it without asking condor again.
+    Built from the pieces below and combined with &, | and ~, e.g.
+        constraint = Constraint.in_dir(cwd) & Constraint.running_for(86400)
+        table = CondorQuery(constraint=constraint, attributes=LongKiller.attributes).table()
+        rows = constraint.rows(snapshot)
+    A constraint made of more pieces joined with & is narrower (see covers()), so the answer to a query
+    can also answer the narrower ones.
+    """
+    def __init__(self, expression, test, terms=None):
+        """
+        :param expression: the ClassAd expression
+        :param test: function (table, row index) -> bool, doing the same on a JobTable
+        :param terms: the pieces the expression requires all of, default is the expression itself
+        """
+        self.expression = expression
+        self.test = test
+        self.terms = terms or frozenset([expression])
+
+    def __str__(self):
+        return self.expression
+
+    def __and__(self, other):
+        return Constraint(f'({self} && {other})', lambda table, i: self.test(table, i) and other.test(table, i),
+                          self.terms | other.terms)
+
+    def covers(self, other):
+        """
+        :param other: a Constraint
+        :return: True if every job matching the other constraint matches this one as well
+        """
+        return self.terms <= other.terms
+
+    def __or__(self, other):
+        return Constraint(f'({self} || {other})', lambda table, i: self.test(table, i) or other.test(table, i))
+
+    def __invert__(self):
+        return Constraint(f'!{self}', lambda table, i: not self.test(table, i))
+
+    @classmethod
+    def any_of(cls, constraints):
+        """
+        Jobs matching any of several constraints, as one flat expression (| nests a level per constraint)
+        :param constraints: the Constraints
+        """
+        constraints = list(constraints)
+        return cls('(' + ' || '.join(map(str, constraints)) + ')',
+                   lambda table, i: any(constraint.test(table, i) for constraint in constraints))
+
+    def rows(self, table):
+        """
+        :param table: the JobTable
+        :return: list of the row indices of the jobs matching the constraint
+        """
+        return [i for i in range(len(table)) if self.test(table, i)]
+
+    @classmethod
+    def in_dir(cls, cwd):
+        """
+        Jobs submitted from a directory or with the script in it, like JobTable.in_dir(). Unlike grep, a
+        sibling directory sharing the beginning of the name does not match
+        :param cwd: the directory, with trailing '/'
+        """
+        # =?= is case sensitive, == is not for strings
+        return cls(f'(substr(strcat(Iwd, "/"), 0, {len(cwd)}) =?= {_quote(cwd)} || '
+                   f'substr(Cmd, 0, {len(cwd)}) =?= {_quote(cwd)})',
+                   lambda table, i: _in_dir(table.iwd[i], table.cmd[i], cwd))
+
+    @classmethod
+    def status(cls, *codes):
+        """
+        Jobs with one of the given JobStatus codes
+        :param codes: JobStatus codes
+        """
+        codes = sorted(set(codes))
+        return cls('(' + ' || '.join(f'JobStatus == {code}' for code in codes) + ')',
+                   lambda table, i: table.status[i] in codes)
+
+    @classmethod
+    def running_for(cls, seconds):
+        """
+        Jobs with at least this much run time, counted like JobTable.run_time()
+        :param seconds: the run time
+        """
+        seconds = int(seconds)
+        return cls(f'(ifThenElse(isUndefined(RemoteWallClockTime), 0, RemoteWallClockTime) + '
+                   f'ifThenElse(JobStatus == {JobStatus.RUNNING}, time() - EnteredCurrentStatus, 0) >= {seconds})',
+                   lambda table, i: table.run_time(i) >= seconds)
+
+    @classmethod
+    def jobs(cls, cluster, procs):
+        """
+        Some jobs of one cluster
+        :param cluster: the ClusterId
+        :param procs: the ProcIds
+        """
+        procs = list(procs)
+        members = set(procs)
+        return cls(f'(ClusterId == {cluster} && member(ProcId, {{{", ".join(map(str, procs))}}}))',
+                   lambda table, i: table.cluster[i] == cluster and table.proc[i] in members)
+
+
+class CondorQuery:
+    """
+    Query condor_q in machine-readable (autoformat) form, so columns never shift
+    with the output format, and parse the result into a JobTable.
+    Global queries ask every schedd at the same time (condor_q -name), each with its own timeout,
+    instead of condor_q -global which asks them one after the other and waits for the slow ones.
+    Schedds that do not answer are listed in table.unreachable (and the error) and their jobs are
+    missing from the table, the others are still there. The schedds are found with condor_status,
+    if that fails the query falls back to condor_q -global.
+    A constraint (see Constraint) and the attributes actually needed can be given, then condor only
+    sends those jobs and fields, e.g.
+        CondorQuery(constraint=Constraint.in_dir(cwd), attributes=('ClusterId', 'ProcId', 'JobStatus', 'Iwd', 'Cmd'))
+    """
+    user = os.environ.get('USER')
+    host = os.environ.get('HOST')
+    fan_out = True
+    workers = 16
+    # seconds a single schedd gets to answer
+    schedd_timeout = 120
+    # how long the list of schedds is kept
+    schedd_ttl = 3600
+    schedd_list = (0., [])
+    schedd_lock = threading.Lock()
+
+    def __init__(self, glob=False, user=None, timeout=None, constraint=None, attributes=None):
+        """
+        :param glob: query all schedds (-global) instead of the local one
+        :param user: owner of the jobs, default is $USER
+        :param timeout: seconds before giving up on condor_q, None to wait forever
+        :param constraint: Constraint (or ClassAd expression string) the jobs have to match, default is all jobs
+        :param attributes: attributes to ask for (see JobTable.attributes), default is all of them
+        """
+        self.glob = glob
+        self.user = user or self.user
+        self.timeout = timeout
+        self.constraint = constraint
+        # in the order of the table, so that Args stays last
+        self.attributes = tuple(name for name in JobTable.attributes if attributes is None or name in attributes)
+        self.options = [self.user] + (['-constraint', str(constraint)] if constraint is not None else []) \
+            + ['-af:t'] + list(self.attributes)
+        self.command = ['condor_q'] + (['-global'] if glob else []) + self.options
+
+    @classmethod
+    def schedds(cls):
+        """
+        The schedds of the pool, asked for once and kept for schedd_ttl seconds
+        :return: list of schedd names, empty if condor_status failed
+        """
+        with cls.schedd_lock:
+            names = cls.known_schedds()
+            if names is None:
+                names = cls.parse_schedds(RCFNavigator(cls.status_command, timeout=cls.schedd_timeout))
+            return names
+
+    status_command = ['condor_status', '-schedd', '-af', 'Name']
+
+    @classmethod
+    def known_schedds(cls):
+        """
+        :return: the list of schedds if it is still fresh, otherwise None
+        """
+        found, names = cls.schedd_list
+        return names if names and time.time() - found < cls.schedd_ttl else None
+
+    @classmethod
+    def parse_schedds(cls, navigator):
+        """
+        Read and remember the schedds from a finished condor_status
+        :param navigator: the finished navigator of status_command
+        :return: list of schedd names, empty if condor_status failed
+        """
+        names = []
+        if navigator.get_process().returncode == 0:
+            names = sorted({line.strip() for line in navigator.get_output().decode('utf-8', 'replace').splitlines()
+                            if line.strip()})
+        cls.schedd_list = (time.time(), names)
+        return names
+
+    def schedd_command(self, name):
+        """
+        :param name: the schedd
+        :return: (argument list, timeout) of the query of one schedd
+        """
+        timeout = min(self.timeout, self.schedd_timeout) if self.timeout else self.schedd_timeout
+        return ['condor_q', '-name', name] + self.options, timeout
+
+    def query_schedd(self, name):
+        """
+        Query one schedd
+        :param name: the schedd
+        :return: the parsed JobTable, with the schedd in unreachable if it did not answer
+        """
+        command, timeout = self.schedd_command(name)
+        return self.schedd_table(name, RCFNavigator(command, timeout=timeout), timeout)
+
+    def schedd_table(self, name, navigator, timeout):
+        """
+        Parse the answer of one schedd
+        :param name: the schedd
+        :param navigator: the finished navigator of its query
+        :param timeout: the timeout the query had
+        :return: the parsed JobTable, with the schedd in unreachable if it did not answer
+        """
+        table = self.parse(navigator.get_output(), navigator.get_error())
+        if table.unreachable or navigator.timed_out or navigator.get_process().returncode != 0:
+            failed = JobTable()
+            failed.complete = table.complete
+            # a 'Timed out' line would read as if the whole query timed out
+            failed.error = '' if navigator.timed_out else table.error
+            if not table.unreachable:
+                reason = f'timed out after {timeout} s' if navigator.timed_out else \
+                    (table.error.strip().splitlines() or ['no answer'])[-1]
+                # in the form of condor_q -global, which is what everybody looks for
+                failed.error += f'-- Failed to fetch ads from: {reason} : {name}\n'
+            # whatever came before the failure is not the whole schedd, so none of it is kept
+            failed.unreachable = [name]
+            failed.queried = [name]
+            return failed
+        table.queried = [name]
+        return table
+
+    def table(self):
+        """
+        Run the query
+        :return: the parsed JobTable
+        """
+        if self.glob and self.fan_out:
+            schedds = self.schedds()
+            if schedds:
+                with ThreadPoolExecutor(max_workers=min(len(schedds), self.workers)) as pool:
+                    return JobTable.merge(list(pool.map(self.query_schedd, schedds)))
+        navigator = RCFNavigator(self.command, timeout=self.timeout)
+        return self.parse(navigator.get_output(), navigator.get_error())
+
+    def parse(self, out, err=b''):
+        """
+        Parse the output of the query
+        :param out: std output of condor_q
+        :param err: std error of condor_q
+        :return: the JobTable
+        """
+        table = JobTable.parse(out, err, self.attributes)
+        table.complete = self.constraint is None
+        # condor_q -global does not say which schedds it asked, the local one is this host
+        table.queried = sorted(set(table.schedd)) if self.glob else [self.host] if self.host else []
+        return table
+
+
+class QueueCache:
+    """
+    Keeps the latest condor_q snapshots for a limited time (TTL), so that NodeChecker, LongKiller
+    and JobMonitor share one query per monitoring cycle instead of asking the schedd again each.
+    A fresh global snapshot also answers local queries (restricted to the jobs of this host).
+    Queries with a constraint are answered from a fresh snapshot of the whole queue if there is one,
+    otherwise condor is asked for only those jobs and the answer is kept for the same query.
+    Anything that changes the queue (condor_rm, condor_release, star-submit) should call invalidate().
+    The lock only guards the snapshots, a query runs without it; whoever asks for a query that is
+    already running waits for its answer instead of starting another one.
+    """
+    host = os.environ.get('HOST')
+
+    def __init__(self, ttl=120, timeout=600):
+        """
+        :param ttl: how long a snapshot stays valid, in seconds
+        :param timeout: seconds before giving up on condor_q, so a hung schedd cannot block forever
+        """
+        self.ttl = ttl
+        self.timeout = timeout
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        # key -> Future of the query running for it
+        self.pending = {}
+        # counts invalidate() calls, an answer to a query started before one is not kept
+        self.generation = 0
+
+    @staticmethod
+    def key(glob=False, user=None, constraint=None, attributes=None):
+        """
+        :return: the key of a query in self.snapshots, (glob, user) for the whole queue,
+                 (glob, user, terms of the constraint, attributes or None for all) otherwise
+        """
+        if constraint is None and attributes is None:
+            return glob, user
+        return (glob, user, constraint.terms if constraint is not None else frozenset(),
+                tuple(sorted(attributes)) if attributes is not None else None)
+
+    def peek(self, glob=False, user=None, constraint=None, attributes=None):
+        """
+        Get the job table from the cache without querying condor
+        :param glob: all schedds (-global) instead of the local one
+        :param user: owner of the jobs, default is $USER
+        :param constraint: only the jobs matching this Constraint
+        :param attributes: the attributes needed, a snapshot with all of them does as well
+        :return: the JobTable, None if there is no fresh snapshot
+        """
+        snapshot = self.whole(glob, user)
+        if snapshot is not None:
+            return snapshot if constraint is None else snapshot.matching(constraint)
+        if constraint is None and attributes is None:
+            return None
+        _, _, terms, names = self.key(glob, user, constraint, attributes)
+        needed = set(names or JobTable.attributes)
+        with self.lock:
+            now = time.time()
+            # the answer to a broader query with the attributes we need, e.g. the jobs of a directory
+            # also answer the jobs of the directory running for too long
+            for key, snapshot in list(self.snapshots.items()):
+                if (len(key) == 2 or key[1] != user or now - snapshot.time >= self.ttl
+                        or not key[2] <= terms or not needed <= set(key[3] or JobTable.attributes)):
+                    continue
+                if key[0] != glob:
+                    if glob:
+                        continue
+                    snapshot = self.local(snapshot)
+                    if snapshot is None:
+                        continue
+                return snapshot if key[2] == terms else snapshot.matching(constraint)
+            return None
+
+    def local(self, snapshot):
+        """
+        The jobs of the local schedd in a global snapshot
+        :param snapshot: the global JobTable
+        :return: the new table, None if the local schedd did not answer
+        """
+        node = (self.host or '').split('.')[0]
+        if any('Failed to fetch ads' in line and node in line for line in snapshot.error.splitlines()):
+            return None
+        local = snapshot.subset([i for i in range(len(snapshot)) if snapshot.node(i) == node])
+        # all jobs of the local schedd are still there, and only those
+        local.complete = snapshot.complete
+        local.queried = [node]
+        return local
+
+    def whole(self, glob=False, user=None):
+        """
+        :return: a fresh snapshot of the whole queue, None if there is none
+        """
+        with self.lock:
+            now = time.time()
+            snapshot = self.snapshots.get((glob, user))
+            if snapshot is not None and now - snapshot.time < self.ttl:
+                return snapshot
+            if not glob:
+                snapshot = self.snapshots.get((True, user))
+                # the global snapshot only helps if the local schedd answered it
+                if snapshot is not None and now - snapshot.time < self.ttl:
+                    return self.local(snapshot)
+            return None
+
+    def table(self, glob=False, user=None, constraint=None, attributes=None):
+        """
+        Get the job table from the cache, query condor if there is no fresh snapshot
+        :param glob: query all schedds (-global) instead of the local one
+        :param user: owner of the jobs, default is $USER
+        :param constraint: only the jobs matching this Constraint
+        :param attributes: the attributes needed, see CondorQuery
+        :return: the JobTable
+        """
+        snapshot = self.peek(glob, user, constraint, attributes)
+        if snapshot is not None:
+            return snapshot
+        key = self.key(glob, user, constraint, attributes)
+        future, generation = self.claim(key)
+        if generation is None:
+            return future.result()
+        try:
+            snapshot = CondorQuery(glob=glob, user=user, timeout=self.timeout, constraint=constraint,
+                                   attributes=attributes).table()
+        except BaseException as error:
+            self.finish(key, future, generation, error=error)
+            raise
+        self.finish(key, future, generation, snapshot)
+        return snapshot
+
+    def claim(self, key):
+        """
+        Join the query running for a key, or become the one running it
+        :param key: see key()
+        :return: (Future of the answer, generation to pass to finish() or None if somebody else runs the query)
+        """
+        with self.lock:
+            future = self.pending.get(key)
+            if future is not None:
+                return future, None
+            future = self.pending[key] = Future()
+            return future, self.generation
+
+    def finish(self, key, future, generation, snapshot=None, error=None):
+        """
+        Keep the answer of a claimed query and hand it to everybody waiting for it
+        :param key: see key()
+        :param future: the Future from claim()
+        :param generation: the generation from claim()
+        :param snapshot: the JobTable
+        :param error: the exception if the query failed
+        """
+        with self.lock:
+            if error is None and generation == self.generation:
+                self.store(key, snapshot)
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if error is None:
+            future.set_result(snapshot)
+        else:
+            future.set_exception(error)
+
+    def store(self, key, snapshot):
+        """
+        Keep a snapshot and forget the ones that expired, call with the lock held
+        :param key: see key()
+        :param snapshot: the JobTable
+        """
+        now = time.time()
+        self.snapshots = {old: table for old, table in self.snapshots.items() if now - table.time < self.ttl}
+        self.snapshots[key] = snapshot
+
+    def refresh(self, glob=False, user=None):
+        """
+        Query condor and replace the snapshot, without a gap in which others would query as well
+        :param glob: query all schedds (-global) instead of the local one
+        :param user: owner of the jobs, default is $USER
+        :return: the new JobTable
+        """
+        snapshot = CondorQuery(glob=glob, user=user, timeout=self.timeout).table()
+        with self.lock:
+            self.snapshots[(glob, user)] = snapshot
+        return snapshot
+
+    def invalidate(self):
+        """
+        Drop all snapshots, call this after changing the queue
+        """
+        with self.lock:
+            self.snapshots.clear()
+            self.generation += 1
+            # queries running now started before the change, the next ones start their own
+            self.pending.clear()
+
+
+class CycleCache(QueueCache):
+    """
+    A QueueCache that serves one fixed snapshot for a whole cycle and never queries condor itself.
+    Used by MultiMonitor to hand every directory its part of the single query of the cycle,
+    invalidation is only remembered so the scheduler knows the queue changed
+    """
+    def __init__(self, table, glob=True, user=None):
+        """
+        :param table: the snapshot
+        :param glob: whether the snapshot covers all schedds
+        :param user: owner of the jobs, as asked for by the monitors
+        """
+        super().__init__(ttl=float('inf'))
+        self.snapshots[(glob, user)] = table
+        self.changed = False
+
+    def peek(self, glob=False, user=None, constraint=None, attributes=None):
+        snapshot = self.whole(glob, user)
+        if snapshot is None:
+            # local view of a snapshot whose local schedd failed, or the other way around, serve what we have
+            snapshot = next(iter(self.snapshots.values()))
+        return snapshot if constraint is None else snapshot.matching(constraint)
+
+    def table(self, glob=False, user=None, constraint=None, attributes=None):
+        return self.peek(glob, user, constraint, attributes)
+
+    def invalidate(self):
+        self.changed = True
+
+
+# shared by everything in this module unless told otherwise
+queue_cache = QueueCache()
+# where state that should survive between runs is kept
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'rcfnav')
+
+
+class NodeIndex:
+    """
+    Index of every directory with jobs of the user to the node(s) running them, built in one pass over
+    a global snapshot and kept on disk for a while (TTL), so check_node.py and LongKiller can answer
+    without asking condor again. A directory matches the jobs submitted from it or below it, and the
+    jobs whose script is there, like in_dir(), e.g.
+        node_index.nodes('/star/data01/pwg/me/run/')   # ['rcas6006', 'rcas6011'], most jobs first
+    """
+    def __init__(self, path=None, ttl=600):
+        """
+        :param path: the index file, default is nodes.json in the cache directory
+        :param ttl: how long the index stays valid, in seconds
+        """
+        self.path = path or os.path.join(cache_dir, 'nodes.json')
+        self.ttl = ttl
+        self.index = None
+        self.lock = threading.Lock()
+
+    def load(self, user):
+        """
+        :param user: owner of the jobs
+        :return: the fresh index of the user from memory or disk, None if there is none
+        """
+        if self.index is None or self.index['user'] != user:
+            try:
+                with open(self.path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if self.index['user'] != user or time.time() - self.index['time'] >= self.ttl:
+            return None
+        return self.index
+
+    @staticmethod
+    def scan(table, user):
+        """
+        Index a snapshot without keeping it
+        :param table: the JobTable
+        :param user: owner of the jobs
+        :return: the index
+        """
+        dirs = {}
+        for i in range(len(table)):
+            node = table.node(i)
+            for path in {table.iwd[i] + '/', os.path.dirname(table.cmd[i]) + '/'}:
+                counts = dirs.setdefault(path, {})
+                counts[node] = counts.get(node, 0) + 1
+        return {'user': user, 'time': table.time, 'dirs': dirs}
+
+    def build(self, table, user):
+        """
+        Rebuild the index from a global snapshot of the whole queue and save it
+        :param table: the JobTable, complete (not a subset or the answer of a constraint)
+        :param user: owner of the jobs
+        :return: the index
+        """
+        index = self.scan(table, user)
+        with self.lock:
+            self.index = index
+            # nobody else has to wait for the disk, an index that fails to save is simply rebuilt next time
+            with contextlib.suppress(OSError):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp = f'{self.path}.{os.getpid()}.tmp'
+                with open(temp, 'w') as f:
+                    json.dump(index, f)
+                os.replace(temp, self.path)
+        return index
+
+    def invalidate(self):
+        """
+        Forget the index, e.g. after resubmitting, so the next lookup rebuilds it
+        """
+        with self.lock:
+            self.index = None
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+
+    def nodes(self, cwd, user=None, cache=None):
+        """
+        Nodes running jobs of a directory, rebuilding the index from the cache if it is stale
+        :param cwd: the directory, with trailing '/'
+        :param user: owner of the jobs, default is $USER
+        :param cache: QueueCache to rebuild from, default is the shared one
+        :return: list of nodes, the one with the most jobs first
+        """
+        cache = cache or queue_cache
+        user = user or os.environ.get('USER')
+        # a fresh snapshot is newer than anything on disk, but only the whole queue may replace the index
+        table = cache.peek(glob=True, user=user)
+        if table is not None and table.complete and (self.index is None or self.index['time'] != table.time):
+            index = self.build(table, user)
+        else:
+            index = self.load(user)
+        if index is None:
+            table = cache.table(glob=True, user=user)
+            # part of the queue (e.g. the jobs of one directory from MultiMonitor) only answers this lookup
+            index = self.build(table, user) if table.complete else self.scan(table, user)
+        counts = {}
+        for path, nodes in index['dirs'].items():
+            if path.startswith(cwd):
+                for node, count in nodes.items():
+                    counts[node] = counts.get(node, 0) + count
+        return sorted(counts, key=counts.get, reverse=True)
+
+
+node_index = NodeIndex()
+
+
 class NodeChecker:
     """
     Useful tool to check which node your jobs are running.
     Currently, only support checking jobs related to current working directory.
-    More utilities could be added if needed.
+    The answer comes from the NodeIndex, so most calls do not need condor at all.
     """
     user = os.environ.get('USER')
     cwd = os.environ.get('PWD') + '/'
-    command = f'condor_q -global {user}'
 
-    def __init__(self):
+    def __init__(self, cache=None, cwd=None, index=None):
         """
-        Initializer, pretty does everything already
+        Initializer, pretty does everything already.
+        :param cache: QueueCache to build the index from, default is the shared one
+        :param cwd: directory of the jobs (with trailing '/'), default is the current working directory
+        :param index: NodeIndex to look the directory up in, default is the shared one
         """
-        self.navigator = RCFNavigator(self.command)
-        self.buffer = AutoBuffer(maxsize=2)
-        for line in self.navigator.get_output().split(b'\n'):
-            # Popen std output contains an extra new line at the end
-            line_str = line[:-1].decode('utf-8')
-            if self.cwd in line_str:
-                # two lines before the line containing pwd
-                self.node = self.buffer.get().split()[2].split('.')[0]
-                break
-            self.buffer.fill(line_str)
+        self.cwd = cwd or self.cwd
+        self.nodes = (index or node_index).nodes(self.cwd, self.user, cache)
         # if the node is not found, use the current host
-        if not hasattr(self, 'node'):
-            self.node = os.environ.get('HOST')
+        self.node = self.nodes[0] if self.nodes else os.environ.get('HOST')
 
     def get_node(self):
         """
         Get the node string, e.g. rcas6006
-        :return: the node string
+        :return: the node string, the one with the most jobs if there are several
         """
         return self.node
 
+    def get_nodes(self):
+        """
+        Get all nodes running jobs of the directory, e.g. ['rcas6006', 'rcas6011']
+        :return: list of node strings, empty if there are no jobs
+        """
+        return self.nodes
+
     def get_node_num(self):
         """
         Get the string number, e.g. 6006 (probably will never need it)
@@ -109,6 +1183,433 @@ class NodeChecker:
         """
         return int(self.get_node()[4:])
 
+class JobRemover:
+    """
+    Remove many jobs with a few condor_rm calls instead of one process per job.
+    Job ids are grouped by schedd, clusters that are removed entirely are passed by cluster id,
+    and the rest goes in bounded chunks. The outcome of every job is parsed from the condor_rm output.
+    For instance, to see what would be run
+        JobRemover(['123.0', '123.1', '124.7']).remove(dry_run=True)
+    """
+    host = os.environ.get('HOST')
+    command = 'condor_rm'
+    chunk_size = 500
+    job_pattern = re.compile(r'Job (\d+\.\d+) (?:has been |already )?marked for removal')
+    cluster_pattern = re.compile(r'All jobs in cluster (\d+) have been marked for removal')
+
+    def __init__(self, job_ids, schedds=None, table=None, chunk_size=None):
+        """
+        :param job_ids: list of job ids, e.g. 123.4
+        :param schedds: schedd of each job, jobs on schedds other than this host get '-name'
+        :param table: JobTable the ids come from, used to find clusters that can be removed as a whole
+        :param chunk_size: maximum number of ids per condor_rm call
+        """
+        self.job_ids = list(job_ids)
+        self.schedds = list(schedds) if schedds is not None else [None] * len(self.job_ids)
+        self.table = table
+        self.chunk_size = chunk_size or self.chunk_size
+
+    def batches(self):
+        """
+        Plan the condor_rm calls
+        :return: list of (argument list, {target: [job ids]}) pairs, a target being a job or a cluster id
+        """
+        local = (self.host or '').split('.')[0]
+        groups = {}
+        for job_id, schedd in zip(self.job_ids, self.schedds):
+            name = None if schedd is None or schedd.split('.')[0] == local else schedd
+            groups.setdefault(name, {}).setdefault(job_id.split('.')[0], []).append(job_id)
+
+        # number of jobs in each cluster, to know whether we are removing all of them,
+        # the answer of a constraint does not have the other jobs of the clusters
+        cluster_size = {}
+        if self.table is not None and self.table.complete:
+            for i in range(len(self.table)):
+                key = (self.table.schedd[i].split('.')[0], str(self.table.cluster[i]))
+                cluster_size[key] = cluster_size.get(key, 0) + 1
+
+        batches = []
+        for schedd, clusters in groups.items():
+            prefix = [self.command] + (['-name', schedd] if schedd else [])
+            targets = []
+            for cluster, ids in clusters.items():
+                if len(ids) == cluster_size.get(((schedd or local).split('.')[0], cluster)):
+                    targets.append((cluster, ids))
+                else:
+                    targets.extend((job_id, [job_id]) for job_id in ids)
+            for start in range(0, len(targets), self.chunk_size):
+                chunk = dict(targets[start:start + self.chunk_size])
+                batches.append((prefix + list(chunk), chunk))
+        return batches
+
+    def remove(self, dry_run=False):
+        """
+        Run (or just print) the planned condor_rm calls
+        :param dry_run: only print the planned calls
+        :return: dictionary of job id -> True if condor_rm reported it as removed
+        """
+        results = {}
+        for args, chunk in self.batches():
+            if dry_run:
+                print(f'[{sum(map(len, chunk.values()))} jobs] ' + ' '.join(args))
+                continue
+            navigator = RCFNavigator(args)
+            results.update(self.outcome(chunk, navigator))
+        return results
+
+    def outcome(self, chunk, navigator):
+        """
+        Read which jobs of one call went through
+        :param chunk: the {target: [job ids]} of the call
+        :param navigator: the finished navigator of the call
+        :return: dictionary of job id -> True if the output reports it
+        """
+        output = (navigator.get_output() + navigator.get_error()).decode('utf-8', 'replace')
+        done = set(self.job_pattern.findall(output))
+        done_clusters = set(self.cluster_pattern.findall(output))
+        return {job_id: job_id in done or target in done_clusters for target, ids in chunk.items() for job_id in ids}
+
+
+class JobReleaser(JobRemover):
+    """
+    Release many held jobs with a few condor_release calls, planned the same way as JobRemover
+        JobReleaser(['123.0', '123.1'], table=table).release(dry_run=True)
+    """
+    command = 'condor_release'
+    job_pattern = re.compile(r'Job (\d+\.\d+) (?:has been )?released')
+    cluster_pattern = re.compile(r'All jobs in cluster (\d+) have been released')
+    # same calls and parsing, only the command and the messages differ
+    release = JobRemover.remove
+
+
+class RateLimiter:
+    """
+    Spaces out calls from any number of threads so that at most `rate` of them start per second
+    """
+    def __init__(self, rate=None):
+        """
+        :param rate: calls per second, None or 0 for no limit
+        """
+        self.interval = 1 / rate if rate else 0
+        self.next = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the caller is allowed to start
+        """
+        time.sleep(self.delay())
+
+    def delay(self):
+        """
+        Take the next slot without waiting for it
+        :return: seconds until the slot
+        """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        return start - now
+
+
+class ResubmitEngine:
+    """
+    Resubmit many star-submit jobs at once. Job numbers are grouped by session xml so one
+    star-submit call covers many jobs, and the calls run on a bounded pool of workers
+    with a rate limit so the submit host is not overwhelmed. For instance
+        engine = ResubmitEngine(['sched1234ABCD_3', 'sched1234ABCD_7'], workers=4, rate=0.5)
+        engine.run()
+        print(engine.summary())
+    """
+    chunk_size = 100
+
+    def __init__(self, sched_names, rel_path='.', workers=4, rate=1.0, kill=True, chunk_size=None):
+        """
+        :param sched_names: names of the star-submit scripts of the jobs, e.g. sched1234ABCD_12
+        :param rel_path: relative path where the session xml files are stored
+        :param workers: maximum number of star-submit calls running at the same time
+        :param rate: maximum number of star-submit calls started per second
+        :param kill: kill the jobs before resubmitting (star-submit -kr), otherwise just resubmit (-r)
+        :param chunk_size: maximum number of jobs per star-submit call
+        """
+        self.sched_names = list(sched_names)
+        self.rel_path = rel_path
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.option = '-kr' if kill else '-r'
+        self.chunk_size = chunk_size or self.chunk_size
+        self.outcomes = {}
+
+    def groups(self):
+        """
+        Plan the star-submit calls
+        :return: list of (session xml, [sched names]) pairs
+        """
+        sessions = {}
+        for name in self.sched_names:
+            sched = name.rsplit('_', 1)[0]
+            sessions.setdefault(os.path.join(self.rel_path, f'{sched}.session.xml'), []).append(name)
+        return [(session, names[start:start + self.chunk_size])
+                for session, names in sessions.items()
+                for start in range(0, len(names), self.chunk_size)]
+
+    def submit(self, session, names):
+        """
+        Resubmit one group of jobs of the same session
+        :param session: path to the session xml
+        :param names: sched names of the jobs
+        :return: (success, output) of the star-submit call
+        """
+        if not os.path.isfile(session):
+            return False, f'{session} not found'
+        self.limiter.wait()
+        navigator = RCFNavigator(self.command(session, names))
+        output = (navigator.get_output() + navigator.get_error()).decode('utf-8', 'replace')
+        return navigator.get_process().returncode == 0, output
+
+    def command(self, session, names):
+        """
+        :param session: path to the session xml
+        :param names: sched names of the jobs
+        :return: argument list of the star-submit call
+        """
+        return ['star-submit', self.option, ','.join(name.rsplit('_', 1)[1] for name in names), session]
+
+    def record(self, names, success, output):
+        """
+        Remember the outcome of one star-submit call
+        :param names: sched names of the jobs of the call
+        :param success: whether it worked
+        :param output: its output, printed if it failed
+        """
+        if not success:
+            print(f'star-submit failed for {len(names)} jobs: {output.strip()}')
+        for name in names:
+            self.outcomes[name] = success
+
+    def run(self, dry_run=False):
+        """
+        Run (or just print) all the planned star-submit calls
+        :param dry_run: only print the planned calls
+        :return: dictionary of sched name -> True if its group was resubmitted successfully
+        """
+        groups = self.groups()
+        if dry_run:
+            for session, names in groups:
+                print(f'[{len(names)} jobs] ' + ' '.join(self.command(session, names)))
+            return {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [(names, pool.submit(self.submit, session, names)) for session, names in groups]
+            for names, future in futures:
+                self.record(names, *future.result())
+        return self.outcomes
+
+    def summary(self):
+        """
+        :return: one-line summary of the last run
+        """
+        failed = [name for name, success in self.outcomes.items() if not success]
+        summary = f'{len(self.outcomes) - len(failed)} jobs resubmitted, {len(failed)} failed'
+        return summary + (': ' + ' '.join(failed) if failed else '')
+
+
+class ReleaseEngine:
+    """
+    Release held jobs according to why they are held, instead of releasing everything of the user.
+    Held jobs are grouped by HoldReasonCode: jobs held by the user or for reasons that will not go away
+    (missing input, executable or output directory, Iwd) stay held, the rest is released with a few condor_release calls.
+    Jobs held for memory get their RequestMemory raised (condor_qedit) before they are released.
+    Every release of a job is counted, a job is only released again after an exponentially growing wait,
+    and jobs that are still held after max_releases releases are killed and resubmitted. For instance
+        engine = ReleaseEngine(table, table.in_dir(cwd), cwd)
+        engine.run(dry_run=True)
+        print(engine.summary())
+    """
+    host = os.environ.get('HOST')
+    # HoldReasonCode of holds that releasing cannot fix
+    user_codes = {1, 15, 16}            # held by the user, submitted on hold, spooling input
+    permanent_codes = {7, 8, 9, 10, 14, 35}     # cannot open output/input, Iwd error, bad docker image
+    # failed to execute (6) or to open a file (13) are permanent when the HoldReasonSubCode (errno) says
+    # the file is not there or not allowed, ENOENT and EACCES
+    permanent_subcodes = {6: {2, 13}, 13: {2, 13}}
+    memory_codes = {34}                 # job went over its memory limit
+    # policy holds (JobPolicy, SystemPolicy) are about memory when the reason says so
+    memory_pattern = re.compile(r'memory', re.IGNORECASE)
+
+    def __init__(self, table, rows, cwd, state_file=None, max_releases=3, backoff=600, memory_factor=1.5,
+                 rel_path=None):
+        """
+        :param table: the JobTable
+        :param rows: rows of the table that belong to the directory
+        :param cwd: the directory, with trailing '/'
+        :param state_file: where the release counts are kept, default is one file per directory in the cache directory
+        :param max_releases: releases of a job before it is killed and resubmitted instead
+        :param backoff: seconds to wait before the second release of a job, doubled for every further release
+        :param memory_factor: RequestMemory is multiplied by this for jobs held for memory
+        :param rel_path: where the session xml files are, for resubmission, default is cwd
+        """
+        rows = list(rows)
+        self.table = table
+        self.rows = [i for i in rows if table.status[i] == JobStatus.HELD]
+        # jobs of the directory still in the queue, on the schedds that answered
+        self.present = {f'{table.schedd[i]}#{table.job_id(i)}' for i in rows}
+        # the schedds the table has all jobs of, also those where none of the directory are left
+        self.covered = table.covered()
+        self.cwd = cwd
+        self.state_file = state_file or os.path.join(cache_dir, 'releases' + cwd.rstrip('/').replace('/', '_') + '.json')
+        self.max_releases = max_releases
+        self.backoff = backoff
+        self.memory_factor = memory_factor
+        self.rel_path = rel_path or cwd
+        try:
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.outcomes = {}
+        self.kept = 0
+        self.waiting = 0
+
+    def classify(self, i):
+        """
+        :param i: row index of a held job
+        :return: 'user', 'permanent', 'memory' or 'retry'
+        """
+        code = self.table.hold_code[i]
+        if code in self.user_codes:
+            return 'user'
+        if code in self.permanent_codes or self.table.hold_subcode[i] in self.permanent_subcodes.get(code, ()):
+            return 'permanent'
+        if code in self.memory_codes or (code in (3, 26) and self.memory_pattern.search(self.table.hold_reason[i])):
+            return 'memory'
+        return 'retry'
+
+    def groups(self):
+        """
+        :return: dictionary of (HoldReasonCode, HoldReason) -> row indices of the held jobs
+        """
+        groups = {}
+        for i in self.rows:
+            groups.setdefault((self.table.hold_code[i], self.table.hold_reason[i]), []).append(i)
+        return groups
+
+    def plan(self, now=None):
+        """
+        Decide what happens to every held job
+        :param now: current time stamp
+        :return: dictionary of action ('keep', 'wait', 'release', 'memory', 'resubmit') -> row indices
+        """
+        now = time.time() if now is None else now
+        plan = {'keep': [], 'wait': [], 'release': [], 'memory': [], 'resubmit': []}
+        for i in self.rows:
+            kind = self.classify(i)
+            if kind in ('user', 'permanent'):
+                plan['keep'].append(i)
+                continue
+            count, last = self.state.get(f'{self.table.schedd[i]}#{self.table.job_id(i)}', (0, 0))
+            if count >= self.max_releases:
+                plan['resubmit'].append(i)
+            elif count and now - last < self.backoff * 2 ** (count - 1):
+                plan['wait'].append(i)
+            else:
+                plan['memory' if kind == 'memory' else 'release'].append(i)
+        return plan
+
+    def raise_memory(self, rows, dry_run=False):
+        """
+        Raise RequestMemory of held jobs, one condor_qedit per schedd and memory value
+        :param rows: row indices
+        :param dry_run: only print the condor_qedit calls
+        :return: set of job ids whose edit succeeded
+        """
+        local = (self.host or '').split('.')[0]
+        groups = {}
+        for i in rows:
+            memory = int(max(self.table.memory[i], 1024) * self.memory_factor)
+            schedd = self.table.schedd[i]
+            name = None if schedd.split('.')[0] == local else schedd
+            groups.setdefault((name, memory), {}).setdefault(self.table.cluster[i], []).append(i)
+        edited = set()
+        for (name, memory), clusters in groups.items():
+            # condor_qedit takes a single job or cluster, a constraint covers them all in one call
+            constraint = Constraint.any_of(Constraint.jobs(cluster, [self.table.proc[i] for i in ids])
+                                           for cluster, ids in clusters.items())
+            args = ['condor_qedit'] + (['-name', name] if name else []) + ['-constraint', str(constraint),
+                                                                          'RequestMemory', str(memory)]
+            ids = [self.table.job_id(i) for i in sum(clusters.values(), [])]
+            if dry_run:
+                print(f'[{len(ids)} jobs] ' + ' '.join(args))
+                continue
+            if RCFNavigator(args).get_process().returncode == 0:
+                edited.update(ids)
+        return edited
+
+    def save(self):
+        """
+        Save the release counts, written to a temporary file first so a crash cannot leave half a file
+        """
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        temp = self.state_file + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp, self.state_file)
+
+    def run(self, dry_run=False):
+        """
+        Release, raise the memory of, or resubmit the held jobs (or just print what would be done)
+        :param dry_run: only print the planned calls
+        :return: dictionary of job id -> action taken ('release', 'memory', 'resubmit'), only for jobs where it succeeded
+        """
+        now = time.time()
+        plan = self.plan(now)
+        table = self.table
+        if plan['memory']:
+            edited = self.raise_memory(plan['memory'], dry_run)
+            plan['memory'] = [i for i in plan['memory'] if table.job_id(i) in edited]
+        releases = plan['release'] + plan['memory']
+        released = {}
+        if releases:
+            released = JobReleaser([table.job_id(i) for i in releases], [table.schedd[i] for i in releases],
+                                   table).release(dry_run)
+        resubmitted = {}
+        if plan['resubmit']:
+            # star-submit -kr, the job comes back with the resources of its session xml
+            resubmitted = ResubmitEngine([table.sched_name(i) for i in plan['resubmit']], self.rel_path).run(dry_run)
+        if dry_run:
+            return {}
+
+        # forget jobs that left the queue, a released job that is held again keeps its count
+        self.state = {key: value for key, value in self.state.items()
+                      if key.split('#', 1)[0].split('.')[0] not in self.covered or key in self.present}
+        self.outcomes = {}
+        for action in ('release', 'memory'):
+            for i in plan[action]:
+                if released.get(table.job_id(i)):
+                    key = f'{table.schedd[i]}#{table.job_id(i)}'
+                    count, _ = self.state.get(key, (0, 0))
+                    self.state[key] = (count + 1, now)
+                    self.outcomes[table.job_id(i)] = action
+        for i in plan['resubmit']:
+            if resubmitted.get(table.sched_name(i)):
+                self.state.pop(f'{table.schedd[i]}#{table.job_id(i)}', None)
+                self.outcomes[table.job_id(i)] = 'resubmit'
+        self.kept = len(plan['keep'])
+        self.waiting = len(plan['wait'])
+        self.save()
+        return self.outcomes
+
+    def summary(self):
+        """
+        :return: the hold reasons and what was done about them in the last run
+        """
+        lines = [f'{len(rows)} held [{code}] {reason}' for (code, reason), rows in
+                 sorted(self.groups().items(), key=lambda item: -len(item[1]))]
+        actions = list(self.outcomes.values())
+        lines.append(f'{actions.count("release")} released, {actions.count("memory")} released with more memory, '
+                     f'{actions.count("resubmit")} resubmitted, {self.waiting} waiting, {self.kept} left held')
+        return '\n'.join(lines)
+
+
 class LongKiller:
     """
     A job killer that targets jobs that have been running too long. Thresholds can be set
@@ -119,36 +1620,70 @@ class LongKiller:
     user = os.environ.get('USER')
     cwd = os.environ.get('PWD') + '/'
     node = os.environ.get('HOST')
-    command = f'condor_q -global {user} | grep {cwd}'
+    # all the killer (and JobHistory) looks at, unless the whole queue is in the cache already
+    attributes = ('ClusterId', 'ProcId', 'JobStatus', 'EnteredCurrentStatus', 'RemoteWallClockTime',
+                  'GlobalJobId', 'Iwd', 'Cmd')
 
-    def __init__(self, _day, _hour=0, local=False):
+    def __init__(self, _day, _hour=0, local=False, cache=None, cwd=None, percentile=None, factor=1.5,
+                 history=None):
         """
         Initializer, does pretty much everything
         :param _day: Day threshold
         :param _hour: Hour threshold
+        :param local: only look at the schedd of this host
+        :param cache: QueueCache to take the queue from, default is the shared one
+        :param cwd: directory of the jobs (with trailing '/'), default is the current working directory
+        :param percentile: if given, the threshold is factor times this percentile of the run times of
+                           the jobs of this directory that completed before (see JobHistory). The day/hour
+                           threshold is only used until there are enough completions
+        :param factor: see percentile
+        :param history: JobHistory to record to and learn from, default is the one in the cache directory
         """
         self.local = local
-        if self.local:
-            self.command = f'condor_q {self.user} | grep {self.cwd}'
-        self.navigator = RCFNavigator(self.command)
+        self.cwd = cwd or self.cwd
+        self.cache = cache or queue_cache
         self.bad_id_list = []
         self.bad_sched_list = []
+        self.bad_schedd_list = []
         self.hour_threshold = _day*24+_hour
+        # the history needs all jobs of the directory, otherwise condor only sends the ones over the threshold
+        self.constraint = self.query(self.cwd, None if percentile is not None else self.hour_threshold)
+        self.table = self.cache.table(glob=not self.local, user=self.user, constraint=self.constraint,
+                                      attributes=self.attributes)
+        rows = self.table.in_dir(self.cwd)
 
-        for line in self.navigator.get_output().split(b'\n'):
-            if line == b'':
-                break
-            # Popen std output contains an extra new line at the end
-            line_str = line[:-1].decode('utf-8')
-            run_time_str = line_str.split()[4]
-            day = int(run_time_str.split('+')[0])
-            hour = day*24+int(run_time_str.split('+')[1].split(':')[0])
-
-            if hour >= _day*24+_hour:
-                self.bad_id_list.append(line_str.split()[0])
-                self.bad_sched_list.append(line_str.split()[11].split('/')[-1].split('.')[0])
-            else:
-                break
+        self.history = history
+        if percentile is not None:
+            if self.history is None:
+                # needs numpy, so only imported when asked for
+                from JobHistory import JobHistory
+                self.history = JobHistory()
+            self.history.record(self.table, rows, self.cwd)
+            threshold = self.history.threshold(self.cwd, percentile, factor)
+            if threshold is not None:
+                self.hour_threshold = threshold / 3600
+
+        # rows are not sorted by run time, so every job has to be looked at
+        for i in rows:
+            if self.table.status[i] == JobStatus.REMOVED:
+                continue
+            if self.table.run_time(i) >= self.hour_threshold * 3600:
+                self.bad_id_list.append(self.table.job_id(i))
+                self.bad_sched_list.append(self.table.sched_name(i))
+                self.bad_schedd_list.append(self.table.schedd[i])
+
+    @staticmethod
+    def query(cwd, hours=None):
+        """
+        The constraint of the jobs the killer asks condor for
+        :param cwd: directory of the jobs (with trailing '/')
+        :param hours: only jobs running for at least this many hours, None for all jobs of the directory
+        :return: the Constraint
+        """
+        constraint = Constraint.in_dir(cwd) & ~Constraint.status(JobStatus.REMOVED)
+        if hours is not None:
+            constraint &= Constraint.running_for(hours * 3600)
+        return constraint
 
     def bad_id(self):
         """
@@ -157,7 +1692,7 @@ class LongKiller:
         """
         return self.bad_id_list
 
-    def kill_bad_job(self):
+    def kill_bad_job(self, dry_run=False, check_node=True):
         """
         Actually kill the bad jobs found. Have to be on the same node though.
         It seems a user can either kill all jobs from an arbitrary node
@@ -168,42 +1703,77 @@ class LongKiller:
         getter may not return the correct node. But if you are on the right node,
         you should still be able to kill the jobs corresponding to your PWD by overriding
         (answering 'y' to the question 'Kill jobs anyway?')
+
+        The jobs are removed in batches by JobRemover
+        :param dry_run: only print the condor_rm calls that would be run
+        :param check_node: ask before killing from the wrong node, off when the caller already asked
+        :return: dictionary of job id -> True if it was removed
         """
         # verify we are on the correct node
-        if not self.local:
-            correct_node = NodeChecker().get_node()
-            if correct_node != self.node:
-                print(f'You are not on the right node! Go to {correct_node}.')
+        if check_node and not self.local and not dry_run:
+            checker = NodeChecker(self.cache, self.cwd)
+            if checker.get_nodes() and self.node not in checker.get_nodes():
+                print(f'You are not on the right node! Go to {" or ".join(checker.get_nodes())}.')
                 override = input("Kill jobs anyway? (y/n)")
                 if override != 'y':
-                    return
+                    return {}
 
         # job killer
-        print(f'Killing {len(self.bad_id_list)} jobs that have been running for more than {self.hour_threshold} hours')
-        for process in self.bad_id_list:
-            sp.run(['condor_rm', process])
+        print(f'Killing {len(self.bad_id_list)} jobs that have been running for more than {self.hour_threshold:g} hours')
+        results = JobRemover(self.bad_id_list, self.bad_schedd_list, self.table).remove(dry_run=dry_run)
+        if dry_run:
+            return results
+        return self.killed(results)
 
-    def kill_and_resubmit(self, rel_path = '.'):
+    def killed(self, results):
+        """
+        Book-keeping after the bad jobs were removed
+        :param results: dictionary of job id -> True if it was removed
+        :return: the results
+        """
+        self.cache.invalidate()
+        if self.history is not None:
+            self.history.record_kills(self.cwd, [(schedd, job_id) for job_id, schedd
+                                                 in zip(self.bad_id_list, self.bad_schedd_list)
+                                                 if results.get(job_id)])
+        failed = [job_id for job_id, removed in results.items() if not removed]
+        print(f'{len(results) - len(failed)} jobs removed, {len(failed)} failed')
+        if failed:
+            print('Failed to remove: ' + ' '.join(failed))
+        return results
+
+    def kill_and_resubmit(self, rel_path = '.', workers=4, rate=1.0, dry_run=False):
         """
         Kill the bad jobs found and resubmit if the sched file can be found
         in the relative path provided
         :param rel_path: relative path where the sched is store, default is
                          current directory
+        :param workers: maximum number of star-submit calls running at the same time
+        :param rate: maximum number of star-submit calls started per second
+        :param dry_run: only print the star-submit calls that would be run
+        :return: dictionary of sched name -> True if it was resubmitted
         """
         # verify we are on the correct node
-        correct_node = NodeChecker().get_node()
-        if correct_node != self.node:
-            print(f'You are not on the right node! Go to {correct_node}.')
+        checker = NodeChecker(self.cache, self.cwd)
+        if checker.get_nodes() and self.node not in checker.get_nodes():
+            print(f'You are not on the right node! Go to {" or ".join(checker.get_nodes())}.')
             override = input("Kill jobs anyway? (y/n)")
             if override != 'y':
-                return
+                return {}
 
         # job killer and resubmitter
-        for index, process in enumerate(self.bad_id_list):
-            sched = self.bad_sched_list[index].split('_')[0]
-            job_number = self.bad_sched_list[index].split('_')[1]
-            # sp.run(['condor_rm', process])
-            sp.run(['star-submit', '-kr', job_number, f'{sched}.session.xml'])
+        engine = ResubmitEngine(self.bad_sched_list, rel_path, workers=workers, rate=rate)
+        outcomes = engine.run(dry_run=dry_run)
+        if not dry_run:
+            self.cache.invalidate()
+            if self.history is not None:
+                # star-submit -kr killed them, even if the resubmission failed they are no completions
+                self.history.record_kills(self.cwd, [(schedd, job_id) for job_id, sched, schedd
+                                                     in zip(self.bad_id_list, self.bad_sched_list,
+                                                            self.bad_schedd_list)
+                                                     if sched in outcomes])
+            print(engine.summary())
+        return outcomes
 
 class DateGetter:
     """
@@ -213,7 +1783,7 @@ class DateGetter:
 
     def __init__(self):
         self.navigator = RCFNavigator(self.command)
-        line = self.navigator.get_output().split(b'\n').readline()
+        line = self.navigator.get_output().split(b'\n')[0]
         self.month, self.date = [line.split()[i].decode('utf-8') for i in (1, 2)]
         # print(f'{month}_{date}')
 
@@ -224,21 +1794,456 @@ class FileMover:
     """
     Find files in the working directory with same names as those in another given directory,
     then move those files to a third designated directory
+    For instance, to see what would be moved
+        FileMover('/path/to/query/').move('/path/to/work/', '/path/to/target/', dry_run=True)
     """
-    command = 'ls -1a '
+    workers = 8
 
     def __init__(self, query_dir):
         """
-        Initialize and obtain a list of file names
+        Initialize and obtain a set of file names
         :param query_dir: the directory with files with the desired names (NOT the working directory)
         """
-        self.navigator = RCFNavigator(self.command + query_dir)
-        self.filenames = [filename[:-1].decode('utf-8') for filename in self.navigator.get_output().split(b'\n')][2:]
+        with os.scandir(query_dir) as entries:
+            self.filenames = {entry.name for entry in entries}
+
+    def move(self, working_dir, target_dir, dry_run=False):
+        """
+        Move the files. Within one filesystem this is a rename, across filesystems the files are
+        copied by a few threads and then removed. Files already in the target directory are skipped
+        :param working_dir: directory the files are moved from
+        :param target_dir: directory the files are moved to
+        :param dry_run: only report what would be done
+        :return: dictionary with the lists of 'moved', 'skipped' and 'failed' file names
+        """
+        with os.scandir(working_dir) as entries:
+            names = {entry.name for entry in entries if entry.is_file()} & self.filenames
+        with os.scandir(target_dir) as entries:
+            existing = {entry.name for entry in entries}
+        summary = {'moved': [], 'skipped': sorted(names & existing), 'failed': []}
+        names = sorted(names - existing)
+        same_filesystem = os.stat(working_dir).st_dev == os.stat(target_dir).st_dev
+
+        if dry_run:
+            summary['moved'] = names
+            print(f'Would {"rename" if same_filesystem else "copy"} {len(names)} files, '
+                  f'skip {len(summary["skipped"])}')
+            return summary
+
+        if same_filesystem:
+            for name in names:
+                try:
+                    os.rename(os.path.join(working_dir, name), os.path.join(target_dir, name))
+                    summary['moved'].append(name)
+                except OSError:
+                    summary['failed'].append(name)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for name, moved in zip(names, pool.map(lambda name: _copy_and_unlink(
+                        os.path.join(working_dir, name), os.path.join(target_dir, name)), names)):
+                    summary['moved' if moved else 'failed'].append(name)
+
+        print(f'Moved {len(summary["moved"])} files, skipped {len(summary["skipped"])}, '
+              f'failed {len(summary["failed"])}')
+        return summary
+
+
+def _copy_and_unlink(source, target):
+    """
+    Move a file across filesystems. The copy goes to a temporary name first,
+    so the target never holds a partial file, and the source is only removed after that
+    :param source: file to move
+    :param target: where it should end up
+    :return: True if the file was moved
+    """
+    temp = target + '.part'
+    try:
+        shutil.copy2(source, temp)
+        os.replace(temp, target)
+        os.unlink(source)
+        return True
+    except OSError:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        return False
+
+class JobLogTailer:
+    """
+    Incrementally reads HTCondor job user logs (the file given by 'log' in the submit file), remembering
+    how far each file has been read, and keeps the latest state of every job seen in them.
+    Only complete events (terminated by a '...' line) are consumed, so a half-written event
+    is picked up on the next read. For instance
+        tailer = JobLogTailer('/path/to/sched*.condor.log')
+        for job_id, code in tailer.read():
+            print(job_id, code)
+    """
+    event_pattern = re.compile(rb'^(\d{3}) \((\d+)\.(\d+)\.\d+\)', re.M)
+    # event codes of the user log and the job status they lead to
+    SUBMIT, EXECUTE, EVICTED, TERMINATED, ABORTED, HELD, RELEASED = 0, 1, 4, 5, 9, 12, 13
+    event_status = {SUBMIT: JobStatus.IDLE, EXECUTE: JobStatus.RUNNING, EVICTED: JobStatus.IDLE,
+                    TERMINATED: JobStatus.COMPLETED, ABORTED: JobStatus.REMOVED,
+                    HELD: JobStatus.HELD, RELEASED: JobStatus.IDLE}
+    # transitions that deserve a look at the queue
+    relevant = {EVICTED, TERMINATED, ABORTED, HELD}
+
+    def __init__(self, pattern):
+        """
+        :param pattern: glob pattern (or list of patterns) of the log files, new files are picked up on every read
+        """
+        self.patterns = [pattern] if isinstance(pattern, str) else list(pattern)
+        self.offsets = {}
+        self.states = {}
+
+    def read(self):
+        """
+        Read whatever was appended to the logs since the last call
+        :return: list of new (job id, event code) pairs, in the order they were logged
+        """
+        events = []
+        for path in sorted({path for pattern in self.patterns for path in glob.glob(pattern)}):
+            offset = self.offsets.get(path, 0)
+            try:
+                with open(path, 'rb') as log:
+                    size = os.fstat(log.fileno()).st_size
+                    if size < offset:
+                        # truncated or replaced, start over
+                        offset = 0
+                    if size == offset:
+                        continue
+                    log.seek(offset)
+                    data = log.read(size - offset)
+            except OSError:
+                continue
+            # only consume up to the end of the last complete event
+            end = data.rfind(b'\n...\n') + 5
+            if end < 5:
+                continue
+            self.offsets[path] = offset + end
+            for match in self.event_pattern.finditer(data, 0, end):
+                code = int(match.group(1))
+                job_id = f'{int(match.group(2))}.{int(match.group(3))}'
+                if code in self.event_status:
+                    self.states[job_id] = self.event_status[code]
+                events.append((job_id, code))
+        return events
+
+    def count_active(self):
+        """
+        :return: number of jobs in the logs that are idle, running or held
+        """
+        return sum(1 for status in self.states.values()
+                   if status in (JobStatus.IDLE, JobStatus.RUNNING, JobStatus.HELD))
+
+
+def _verify_output(path, min_size, checksum, trailer):
+    """
+    Check one output file, run in the worker processes of OutputVerifier.
+    The file is memory-mapped, so only the pages that are looked at are read
+    :param path: the file
+    :param min_size: smaller files are bad
+    :param checksum: also compute the adler32 of the whole file
+    :param trailer: number of bytes at the end of the file that must not all be zero
+    :return: (size, mtime in ns, reason it is bad or None, adler32 as hex or None)
+    """
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size == 0 or stat.st_size < min_size:
+                return stat.st_size, stat.st_mtime_ns, f'only {stat.st_size} bytes', None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if path.endswith('.root'):
+                    # 'root', version, fBEGIN, fEND (8 bytes for big files), fEND is the size once the file is closed
+                    if data[:4] != b'root':
+                        return stat.st_size, stat.st_mtime_ns, 'not a ROOT file', None
+                    version = int.from_bytes(data[4:8], 'big')
+                    end = int.from_bytes(data[12:20] if version >= 1000000 else data[12:16], 'big')
+                    if end != stat.st_size:
+                        return stat.st_size, stat.st_mtime_ns, f'not closed properly (fEND {end})', None
+                if not data[-trailer:].strip(b'\0'):
+                    return stat.st_size, stat.st_mtime_ns, 'ends with zeros', None
+                value = None
+                if checksum:
+                    value = 1
+                    view = memoryview(data)
+                    try:
+                        for start in range(0, len(data), 1 << 24):
+                            value = zlib.adler32(view[start:start + (1 << 24)], value)
+                    finally:
+                        view.release()
+                    value = f'{value:08x}'
+                return stat.st_size, stat.st_mtime_ns, None, value
+    except (OSError, ValueError) as error:
+        return -1, -1, f'unreadable ({error})', None
+
+
+class OutputVerifier:
+    """
+    Check that output files are complete before they count as present: a minimum size, the header and
+    fEND of ROOT files, a trailer that is not all zeros, and optionally an adler32 checksum.
+    The files are checked by a pool of processes with memory-mapped reads, and verdicts are kept by
+    (path, size, mtime), so only new or changed files are read again, e.g.
+        verdicts = {}
+        bad = OutputVerifier(min_size=10000).verify(paths, verdicts)
+    """
+    min_size = 1024
+    trailer = 4096
+
+    def __init__(self, min_size=None, checksums=None, workers=None):
+        """
+        :param min_size: files smaller than this many bytes are bad
+        :param checksums: dictionary of file name -> expected adler32 (hex), or True to only compute them
+        :param workers: number of processes, default is the number of CPUs
+        """
+        self.min_size = self.min_size if min_size is None else min_size
+        self.checksums = checksums
+        self.workers = workers or os.cpu_count()
+
+    def verify(self, paths, verdicts=None):
+        """
+        Check files, reading only those not in the verdicts yet or changed since
+        :param paths: the files
+        :param verdicts: dictionary of path -> [size, mtime, reason, adler32], updated in place
+        :return: dictionary of path -> reason for the bad files
+        """
+        verdicts = {} if verdicts is None else verdicts
+        todo = []
+        for path in paths:
+            verdict = verdicts.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                verdict = None
+            else:
+                if verdict is not None and (verdict[0], verdict[1]) != (stat.st_size, stat.st_mtime_ns):
+                    verdict = None
+            if verdict is None or (self.checksums and verdict[2] is None and verdict[3] is None):
+                todo.append(path)
+        if todo:
+            workers = min(self.workers, len(todo))
+            arguments = (todo, [self.min_size] * len(todo), [bool(self.checksums)] * len(todo),
+                         [self.trailer] * len(todo))
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    results = list(pool.map(_verify_output, *arguments, chunksize=max(1, len(todo) // (4 * workers))))
+            else:
+                results = list(map(_verify_output, *arguments))
+            for path, result in zip(todo, results):
+                verdicts[path] = list(result)
+        bad = {}
+        for path in paths:
+            size, mtime, reason, value = verdicts[path]
+            expected = self.checksums.get(os.path.basename(path)) if isinstance(self.checksums, dict) else None
+            if reason is None and expected is not None and value != expected.lower():
+                reason = f'checksum {value} instead of {expected}'
+            if reason is not None:
+                bad[path] = reason
+        return bad
+
+
+class MissingTracker:
+    """
+    Keeps track of which jobs have not produced their output yet, without rescanning the
+    output directory when nothing changed. The expected outputs are derived from the star-submit
+    scripts (sched<ID>_<N>.csh) in the submission directory and a file name pattern, e.g.
+        tracker = MissingTracker('/path/to/output', pattern='{name}.root')
+        print(tracker.missing())
+    The state (manifest, directory mtimes and outputs found) is saved to a small json file
+    under ~/.cache/rcfnav, so it survives between runs.
+    With an OutputVerifier, outputs that are there but bad (truncated, empty, ...) count as missing too.
+    """
+    script_pattern = re.compile(r'^(sched\w+)_(\d+)\.csh$')
+
+    def __init__(self, output_dir, pattern='{name}.root', script_dir=None, state_file=None, verifier=None):
+        """
+        :param output_dir: directory where the outputs end up
+        :param pattern: output file name of a job, with {name} (e.g. sched1234ABCD_12), {sched} and {job}
+        :param script_dir: directory with the sched*.csh scripts, default is the current working directory
+        :param state_file: where to save the state, default is named after script_dir in the cache directory
+        :param verifier: OutputVerifier to check the outputs with, otherwise an output is fine once it is there
+        """
+        self.output_dir = output_dir
+        self.verifier = verifier
+        # sched name -> why its output is bad, from the last missing()
+        self.bad = {}
+        self.pattern = pattern
+        self.script_dir = script_dir or os.environ.get('PWD')
+        # not in script_dir itself, saving would change its mtime
+        self.state_file = state_file or os.path.join(
+            cache_dir, 'missing' + os.path.abspath(self.script_dir).replace('/', '_') + '.json')
+        self.changed = False
+        self.state = {'pattern': pattern, 'script_mtime': None, 'manifest': {},
+                      'output_mtime': None, 'present': [], 'verdicts': {}}
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state.get('pattern') == pattern:
+                self.state.update(state)
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        """
+        Save the state if it changed, written to a temporary file first so a crash cannot leave half a file
+        """
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        temp = self.state_file + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp, self.state_file)
+        self.changed = False
+
+    def manifest(self):
+        """
+        Expected output of every job, rebuilt only when the script directory changed
+        :return: dictionary of sched name -> expected output file name
+        """
+        mtime = os.stat(self.script_dir).st_mtime_ns
+        if mtime != self.state['script_mtime']:
+            manifest = {}
+            with os.scandir(self.script_dir) as entries:
+                for entry in entries:
+                    match = self.script_pattern.match(entry.name)
+                    if match:
+                        name = entry.name[:-4]
+                        manifest[name] = self.pattern.format(name=name, sched=match.group(1), job=match.group(2))
+            self.state['manifest'] = manifest
+            self.state['script_mtime'] = mtime
+            self.changed = True
+        return self.state['manifest']
+
+    def present(self):
+        """
+        Names of the files in the output directory, rescanned only when the directory changed
+        :return: set of file names
+        """
+        try:
+            mtime = os.stat(self.output_dir).st_mtime_ns
+        except FileNotFoundError:
+            return set()
+        if mtime != self.state['output_mtime']:
+            with os.scandir(self.output_dir) as entries:
+                self.state['present'] = [entry.name for entry in entries]
+            self.state['output_mtime'] = mtime
+            self.changed = True
+        return set(self.state['present'])
+
+    def missing(self):
+        """
+        :return: sorted list of sched names of the jobs whose output is missing (or bad)
+        """
+        present = self.present()
+        manifest = self.manifest()
+        missing = [name for name, output in manifest.items() if output not in present]
+        self.bad = {}
+        if self.verifier is not None:
+            paths = {os.path.join(self.output_dir, output): name for name, output in manifest.items()
+                     if output in present}
+            verdicts = self.state['verdicts']
+            before = {path: verdicts.get(path) for path in paths}
+            bad = self.verifier.verify(list(paths), verdicts)
+            # only the outputs we still expect are worth remembering
+            self.state['verdicts'] = {path: verdicts[path] for path in paths}
+            if any(before[path] != verdicts[path] for path in paths) or len(verdicts) != len(paths):
+                self.changed = True
+            self.bad = {paths[path]: reason for path, reason in bad.items()}
+            missing += self.bad
+        self.save()
+        return sorted(missing)
+
+
+class PollScheduler:
+    """
+    Decides how long to wait between two checks of the queue. The wait gets shorter when the number
+    of jobs falls fast or gets close to zero, and backs off exponentially (with jitter) when nothing
+    changes (an empty queue included) or the schedd cannot be reached. The time to completion is estimated with a straight-line
+    fit of the recent job counts.
+        poller = PollScheduler()
+        poller.observe(count_all)
+        exit.wait(poller.next_interval())
+    """
+    def __init__(self, base=600, minimum=60, maximum=3600, window=6):
+        """
+        :param base: seconds to wait when nothing special is going on
+        :param minimum: shortest wait
+        :param maximum: longest wait, also for backing off
+        :param window: number of recent job counts used for the estimates
+        """
+        self.base = base
+        self.minimum = minimum
+        self.maximum = maximum
+        self.counts = deque(maxlen=window)
+        self.unchanged = 0
+        self.failures = 0
+
+    def observe(self, count, now=None):
+        """
+        Record the number of jobs in the queue after a check
+        :param count: number of jobs
+        :param now: time stamp of the check
+        """
+        if self.counts and self.counts[-1][1] == count:
+            self.unchanged += 1
+        else:
+            self.unchanged = 0
+        self.counts.append((time.time() if now is None else now, count))
+        self.failures = 0
+
+    def rate(self):
+        """
+        :return: jobs leaving the queue per second (least squares over the recent counts), None if unknown
+        """
+        if len(self.counts) < 2:
+            return None
+        n = len(self.counts)
+        mean_t = sum(t for t, _ in self.counts) / n
+        mean_c = sum(c for _, c in self.counts) / n
+        var = sum((t - mean_t) ** 2 for t, _ in self.counts)
+        if var == 0:
+            return None
+        return -sum((t - mean_t) * (c - mean_c) for t, c in self.counts) / var
+
+    def eta(self):
+        """
+        :return: estimated seconds until the queue is empty, None if it is not getting smaller
+        """
+        rate = self.rate()
+        if not rate or rate <= 0:
+            return None
+        return self.counts[-1][1] / rate
+
+    def jitter(self, interval):
+        # spread the checks of many monitors so they do not hit the schedd at the same time
+        return interval * random.uniform(0.8, 1.2)
+
+    def next_interval(self):
+        """
+        :return: seconds to wait before the next check
+        """
+        if not self.counts:
+            return self.base
+        # a count that stays the same backs off first, also at zero: a queue that stays empty while
+        # outputs keep being resubmitted (e.g. star-submit failing) is not checked every minute
+        if self.unchanged:
+            return min(self.jitter(self.base * 2 ** self.unchanged), self.maximum)
+        if self.counts[-1][1] == 0:
+            # just emptied, confirm soon
+            return self.minimum
+        eta = self.eta()
+        if eta is not None:
+            # check a few times on the way to completion
+            return max(self.minimum, min(eta / 3, self.base))
+        return self.base
+
+    def failed(self):
+        """
+        Record a failed check
+        :return: seconds to wait before trying again
+        """
+        self.failures += 1
+        return min(self.jitter(self.minimum * 2 ** self.failures), self.maximum)
 
-    def move(self, working_dir, target_dir):
-        for file in self.filenames:
-           sp.run(['mv', working_dir+file, target_dir+file])
-        # print(self.filenames)
 
 class JobMonitor:
     """
@@ -248,74 +2253,123 @@ class JobMonitor:
     user = os.environ.get('USER')
     cwd = os.environ.get('PWD') + '/'
     node = os.environ.get('HOST')
-    command = f'condor_q {user} | grep {cwd}'
     command_missing = f'/star/u/maxwoo/python/Python-3.10.4/python check_missing_files.py'
     # command_resubmit = f'sh resubmit.sh'
+    # what counting the jobs and releasing the held ones looks at, and LongKiller in the same cycle
+    # (which is then answered from the same query)
+    attributes = ('ClusterId', 'ProcId', 'JobStatus', 'EnteredCurrentStatus', 'RemoteWallClockTime', 'GlobalJobId',
+                  'Iwd', 'Cmd', 'HoldReasonCode', 'HoldReasonSubCode', 'RequestMemory', 'HoldReason')
 
-    def __init__(self, email, days=1, hours=0, debug=False, glob=False):
+    def __init__(self, email, days=1, hours=0, debug=False, glob=False, cache=None, tracker=None,
+                 cwd=None, retry=True, percentile=None):
+        """
+        :param email: address for the completion notification
+        :param days: day threshold for killing long jobs
+        :param hours: hour threshold for killing long jobs
+        :param debug: print what is being checked
+        :param glob: look for the jobs on all schedds
+        :param cache: QueueCache to take the queue from, default is the shared one
+        :param tracker: MissingTracker for the outputs, default is running check_missing_files.py
+        :param cwd: directory of the jobs (with trailing '/'), default is the current working directory
+        :param retry: wait and query again when the node is unaccessible, otherwise give up on this cycle
+        :param percentile: kill jobs by the run time history of the directory instead of days/hours,
+                           see LongKiller
+        """
+        self.percentile = percentile
+        self.poller = PollScheduler()
+        # set by the "check now" signal, also cuts short the wait for an unaccessible node
+        self.exit = threading.Event()
         self.email = email
+        self.cwd = cwd or self.cwd
+        self.retry = retry
+        self.cache = cache or queue_cache
+        self.tracker = tracker
+        self.missing_jobs = []
         self.count_missing = 0
         self.count_all = 0
         self.days = days
         self.hours = hours
         self.debug = debug
         self.glob = glob
-        if self.glob:
-            self.command = f'condor_q -global {self.user} | grep {self.cwd}'
+        # condor only sends the jobs of this directory, the same LongKiller narrows down
+        self.constraint = LongKiller.query(self.cwd)
+        # the run times are learned from it, so every kill of the monitor has to be recorded in it,
+        # otherwise the killed jobs count as completions
+        self.history = None
+        if percentile is not None:
+            from JobHistory import JobHistory
+            self.history = JobHistory()
 
     def check_queue(self):
+        """
+        Count the jobs in the queue and release the held ones
+        :return: False if the node could not be reached (only without retry)
+        """
         ### number of jobs found
         if self.debug:
             print('Checking queue...')
         while True:
-            navigator = RCFNavigator(self.command)
-            count_all = 0
-            count_running = 0
-            count_idle = 0
-            count_held = 0
-            status = 0
+            if self.glob:
+                # first, when the index needs the whole queue the jobs of the directory come out of it as well
+                self.node = NodeChecker(self.cache, self.cwd).get_node()
+            table = self.cache.table(glob=self.glob, user=self.user, constraint=self.constraint,
+                                     attributes=self.attributes)
             if self.debug:
                 print('Checking command error...')
-            if self.glob:
-                self.node = NodeChecker().get_node()
-            for line in navigator.get_error().split(b'\n'):
-                if 'Failed to fetch ads' in line.decode('utf-8') and self.node in line.decode('utf-8'):
-                    print('Node is unaccessible, recheck in 10 minutes')
-                    status = 1
-                    break
-            if status == 1:
-                time.sleep(600)
+            if any(('Failed to fetch ads' in line and self.node in line) or line.startswith('Timed out')
+                   for line in table.error.splitlines()):
+                if not self.retry:
+                    print(f'Node {self.node} is unaccessible, skipping {self.cwd}')
+                    return False
+                delay = self.poller.failed()
+                print(f'Node is unaccessible, recheck in {delay / 60:.0f} minutes')
+                self.cache.invalidate()
+                self.exit.wait(delay)
+                self.exit.clear()
                 continue
             if self.debug:
                 print('Checking command output...')
-            for line in navigator.get_output().split(b'\n'):
-                if self.user not in line.decode('utf-8') or ' X ' in line.decode('utf-8'):
-                    continue
-                count_all += 1
-                if ' R ' in line.decode('utf-8'):
-                    count_running += 1
-                if ' I ' in line.decode('utf-8'):
-                    count_idle += 1
-                if ' H ' in line.decode('utf-8'):
-                    count_held += 1
+            rows = [i for i in table.in_dir(self.cwd) if table.status[i] != JobStatus.REMOVED]
+            counts = table.count_status(rows)
+            count_all = sum(counts.values())
+            count_running = counts.get(JobStatus.RUNNING, 0)
+            count_idle = counts.get(JobStatus.IDLE, 0)
+            count_held = counts.get(JobStatus.HELD, 0)
             break
 
         self.count_all = count_all
+        self.poller.observe(count_all)
         print(f'Jobs found: {count_all}, Running: {count_running}, Idle: {count_idle}, Held: {count_held}')
 
-        # releasing held jobs
+        # releasing held jobs, only those of this directory that are worth it
         if count_held > 0:
             print('Releasing held jobs...')
-            navigator = RCFNavigator(f'condor_release {self.user}')
-            for line in navigator.get_output().split(b'\n'):
-                print(line.decode('utf-8'))
+            engine = ReleaseEngine(table, rows, self.cwd)
+            if engine.run():
+                self.cache.invalidate()
+            print(engine.summary())
+        return True
     
     def check_missing(self):
-        navigator = RCFNavigator(self.command_missing)
-        self.count_missing = int(navigator.get_output().split(b'\n')[0].decode('utf-8'))
-        print(f'Missing files: {self.count_missing}')
+        if self.tracker is not None:
+            self.missing_jobs = self.tracker.missing()
+            self.count_missing = len(self.missing_jobs)
+            for name, reason in sorted(self.tracker.bad.items()):
+                print(f'Bad output of {name}: {reason}')
+        else:
+            navigator = RCFNavigator(self.command_missing)
+            self.count_missing = int(navigator.get_output().split(b'\n')[0].decode('utf-8'))
+        print(f'Missing files: {self.count_missing}'
+              + (f' ({len(self.tracker.bad)} bad)' if self.tracker is not None and self.tracker.bad else ''))
 
     def resubmit(self):
+        if self.tracker is not None:
+            # the jobs are out of the queue (finished or killed), resubmit exactly the missing ones
+            engine = ResubmitEngine(self.missing_jobs, self.cwd, kill=False)
+            engine.run()
+            self.cache.invalidate()
+            print(engine.summary())
+            return
         navigator = RCFNavigator(self.command_resubmit)
         output = navigator.get_output().split(b'\n')
         resubmit_count = 0
@@ -324,7 +2378,8 @@ class JobMonitor:
                 resubmit_count += 1
         if resubmit_count != self.count_missing:
             print(f'WARNING: number of resubmission ({resubmit_count}) does not match number of missing files ({self.count_missing}). Killing all jobs...')
-            LongKiller(0, 0, local=True).kill_bad_job()
+            LongKiller(0, 0, local=True, cache=self.cache, cwd=self.cwd, history=self.history).kill_bad_job()
+        self.cache.invalidate()
         print(f'{self.count_missing} jobs resubmitted')
     
     def email_notification(self):
@@ -337,40 +2392,262 @@ class JobMonitor:
 }} | /usr/sbin/sendmail -t'''.format(self.email, self.node, self.cwd)
         sp.run(script, shell=True)
                
-    def task(self):
-        self.check_queue()
-        LongKiller(self.days, self.hours, local=True).kill_bad_job()
-        self.check_missing()
+    def task(self, invalidate=True):
+        with metrics.span('JobMonitor.task'):
+            return self.run_task(invalidate)
+
+    def run_task(self, invalidate=True):
+        # every cycle starts from a fresh snapshot, which is then shared by everything below
+        if invalidate:
+            self.cache.invalidate()
+        with metrics.span('JobMonitor.check_queue'):
+            if not self.check_queue():
+                return False
+        with metrics.span('JobMonitor.kill_long'):
+            LongKiller(self.days, self.hours, local=True, cache=self.cache, cwd=self.cwd,
+                       percentile=self.percentile, history=self.history).kill_bad_job()
+        with metrics.span('JobMonitor.check_missing'):
+            self.check_missing()
         if self.count_missing < 5:
             if self.count_all == 0:
+                if self.tracker is not None and self.tracker.bad:
+                    # a few missing outputs are tolerated, bad ones are not
+                    print('Resubmitting jobs with bad outputs...')
+                    with metrics.span('JobMonitor.resubmit'):
+                        self.resubmit()
+                    return False
                 self.email_notification()
                 return True
         elif self.count_all == 0:
             print('No jobs found, resubmitting...')
-            self.resubmit()
+            with metrics.span('JobMonitor.resubmit'):
+                self.resubmit()
         elif self.count_missing > 20 * self.count_all:
             # it might be worth it to kill all jobs and resubmit in this case
             print('Too many missing files, kill and resubmit remaining jobs')
-            LongKiller(0, 0, local=True).kill_bad_job()
-            self.resubmit()
+            with metrics.span('JobMonitor.resubmit'):
+                LongKiller(0, 0, local=True, cache=self.cache, cwd=self.cwd, history=self.history).kill_bad_job()
+                self.resubmit()
         return False
 
     def loop(self, exit: threading.Event):
         print(f'Starting from node {self.node}...')
+        self.exit = exit
         while True:
             done = self.task()
             if done:
                 break
-            print('Check again in 10 minutes. Press Ctrl+\\ to check now')
-            exit.wait(600)
+            interval = self.poller.next_interval()
+            eta = self.poller.eta()
+            print(f'Check again in {interval / 60:.0f} minutes'
+                  + (f' (about {eta / 3600:.1f} hours to completion)' if eta is not None else '')
+                  + '. Press Ctrl+\\ to check now')
+            exit.wait(interval)
             if exit.is_set():
                 exit.clear()
                 continue
     
+    def event_loop(self, exit: threading.Event, log_pattern, poll=5, min_interval=60, max_interval=3600):
+        """
+        Event-driven alternative to loop(): tail the job user logs and only run task() when a job
+        terminates, is held, evicted or aborted, instead of querying everything every 10 minutes.
+        Between events the only cost is a stat of the log files.
+        :param exit: event set by the "check now" signal
+        :param log_pattern: glob pattern of the job user logs
+        :param poll: seconds between reads of the logs
+        :param min_interval: minimum seconds between two task() triggered by events, unless all jobs are done
+        :param max_interval: run task() at least this often, in case events are missed
+        """
+        print(f'Starting from node {self.node}, watching {log_pattern}...')
+        self.exit = exit
+        tailer = JobLogTailer(log_pattern)
+        # catch up with the history first, the queue is checked right away anyway
+        tailer.read()
+        while True:
+            done = self.task()
+            if done:
+                break
+            last_task = time.monotonic()
+            print(f'Waiting for job events. Press Ctrl+\\ to check now')
+            pending = 0
+            while True:
+                exit.wait(poll)
+                if exit.is_set():
+                    exit.clear()
+                    break
+                pending += sum(1 for _, code in tailer.read() if code in JobLogTailer.relevant)
+                since = time.monotonic() - last_task
+                if pending and tailer.count_active() == 0:
+                    print('All jobs in the logs have left the queue, checking now')
+                    break
+                if pending and since >= min_interval:
+                    print(f'{pending} job events, checking now')
+                    break
+                if since >= max_interval:
+                    break
+
+    def start(self, log_pattern=None):
+        """
+        Start monitoring, press Ctrl+\\ to check now
+        :param log_pattern: glob pattern of the job user logs, if given monitor by events instead of polling
+        """
+        exit = threading.Event()
+        def quit(signo, _frame):
+            print(f'Interrupted by {signo}, checking now')
+            exit.set()
+        signal.signal(signal.SIGQUIT, quit)
+        if log_pattern:
+            self.event_loop(exit, log_pattern)
+        else:
+            self.loop(exit)
+
+
+class ThreadOutput:
+    """
+    Stand-in for sys.stdout that keeps what a thread prints inside capture() apart, everything else goes
+    to the real stream. For threads that print a report each, so the reports do not get mixed up, e.g.
+        sys.stdout = output = ThreadOutput(sys.stdout)
+        with output.capture():   # in each thread
+            ...                  # printed in one piece when the block ends
+    """
+    def __init__(self, stream):
+        """
+        :param stream: the real stdout
+        """
+        self.stream = stream
+        self.local = threading.local()
+        # one report at a time on the real stream
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        return (getattr(self.local, 'buffer', None) or self.stream).write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Keep what this thread prints until the block ends, then write it to the real stream in one piece
+        :return: the StringIO it is kept in
+        """
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            report, self.local.buffer = self.local.buffer.getvalue(), None
+            with self.lock:
+                self.stream.write(report)
+                self.stream.flush()
+
+
+class MultiMonitor:
+    """
+    Watch many directories from one process with one condor_q per cycle, however many directories there are.
+    Each entry is a dictionary with at least 'dir' and 'email', and optionally 'days', 'hours', 'percentile'
+    (see LongKiller), 'output_dir' and 'pattern' (for a MissingTracker), 'verify' and 'min_size'
+    (for an OutputVerifier), e.g.
+        MultiMonitor([{'dir': '/star/data01/pwg/me/run1/', 'email': 'me@bnl.gov', 'days': 1},
+                      {'dir': '/star/data01/pwg/me/run2/', 'email': 'me@bnl.gov', 'hours': 12}]).start()
+    The queue is partitioned by directory in memory and the directories are handled concurrently,
+    each printing its report in one block when it is done (see ThreadOutput).
+    Their state is saved between cycles, so finished directories are not checked (or emailed) again.
+    """
+    user = os.environ.get('USER')
+
+    def __init__(self, entries, workers=4, glob=True, state_file=None, interval=600):
+        """
+        :param entries: list of directory entries, see above
+        :param workers: maximum number of directories handled at the same time
+        :param glob: query all schedds (-global) instead of the local one
+        :param state_file: where to save the per-directory state, default is in the cache directory
+        :param interval: seconds between cycles, adapted to the progress of the jobs (see PollScheduler)
+        """
+        self.entries = [dict(entry, dir=os.path.join(entry['dir'], '')) for entry in entries]
+        self.workers = workers
+        self.glob = glob
+        self.poller = PollScheduler(base=interval)
+        self.state_file = state_file or os.path.join(cache_dir, 'multimonitor.json')
+        self.state = {}
+        try:
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        temp = self.state_file + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(temp, self.state_file)
+
+    def monitor(self, entry, table):
+        """
+        Run one cycle of JobMonitor for one directory on its part of the queue
+        :param entry: the directory entry
+        :param table: the jobs of this directory
+        :return: True if the directory is done
+        """
+        tracker = None
+        if entry.get('output_dir'):
+            verifier = OutputVerifier(entry.get('min_size')) if entry.get('verify') else None
+            tracker = MissingTracker(entry['output_dir'], entry.get('pattern', '{name}.root'), entry['dir'],
+                                     verifier=verifier)
+        cache = CycleCache(table, self.glob, self.user)
+        monitor = JobMonitor(entry['email'], entry.get('days', 1), entry.get('hours', 0), glob=self.glob,
+                             cache=cache, tracker=tracker, cwd=entry['dir'], retry=False,
+                             percentile=entry.get('percentile'))
+        print(f'--- {entry["dir"]}')
+        done = monitor.task(invalidate=False)
+        self.state[entry['dir']] = {'done': done, 'jobs': monitor.count_all, 'missing': monitor.count_missing,
+                                    'queue_changed': cache.changed, 'checked': time.time()}
+        return done
+
+    def cycle(self):
+        """
+        One query, then every directory that is not done yet
+        :return: True if all directories are done
+        """
+        entries = [entry for entry in self.entries if not self.state.get(entry['dir'], {}).get('done')]
+        if not entries:
+            return True
+        table = CondorQuery(glob=self.glob, user=self.user, timeout=queue_cache.timeout).table()
+        if self.glob:
+            # the monitors only get their own part of the queue, the index is built from all of it here
+            node_index.build(table, self.user)
+        parts = table.partition([entry['dir'] for entry in entries])
+        self.poller.observe(sum(len(rows) for rows in parts.values()))
+        stdout = sys.stdout
+        sys.stdout = output = ThreadOutput(stdout)
+
+        def monitor(entry):
+            with output.capture():
+                return self.monitor(entry, table.subset(parts[entry['dir']]))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                done = list(pool.map(monitor, entries))
+        finally:
+            sys.stdout = stdout
+        self.save()
+        return all(done)
+
+    def loop(self, exit: threading.Event):
+        print(f'Watching {len(self.entries)} directories...')
+        while not self.cycle():
+            interval = self.poller.next_interval()
+            print(f'Check again in {interval / 60:.0f} minutes. Press Ctrl+\\ to check now')
+            exit.wait(interval)
+            exit.clear()
+
     def start(self):
         exit = threading.Event()
         def quit(signo, _frame):
             print(f'Interrupted by {signo}, checking now')
             exit.set()
         signal.signal(signal.SIGQUIT, quit)
-        self.loop(exit)
\ No newline at end of file
+        self.loop(exit)
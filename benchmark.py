@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the hot paths of RCFNavigator (parsing, NodeChecker, LongKiller, JobMonitor) against the
+fake condor tools in fake_condor/, reporting wall time, number of condor processes started and
+peak Python memory. For instance
+    python3 benchmark.py --jobs 1000 100000 500000 --schedds 4
+
+Captured outputs of the real 'condor_q -global $USER -af:t ...' (see JobTable.attributes) can be
+replayed for regression checks:
+    python3 benchmark.py --replay captured.txt --cwd /star/data01/pwg/me/run/ --record expected.json
+    python3 benchmark.py --replay captured.txt --cwd /star/data01/pwg/me/run/ --expect expected.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, 'fake_condor'))
+import fakecondor
+
+
+def count_calls():
+    """
+    :return: number of fake condor processes started so far
+    """
+    try:
+        with open(os.path.join(fakecondor.state_dir(), 'calls.log')) as log:
+            return sum(1 for _ in log)
+    except FileNotFoundError:
+        return 0
+
+
+def measure(func, setup=None):
+    """
+    Run func twice, once for the wall time and the number of processes, once under tracemalloc
+    :param func: the hot path
+    :param setup: called before each run, not measured
+    :return: (wall time in seconds, number of processes, peak memory in MB)
+    """
+    results = []
+    for trace in (False, True):
+        if setup is not None:
+            setup()
+        calls = count_calls()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        wall = time.perf_counter() - start
+        if trace:
+            results.append(tracemalloc.get_traced_memory()[1] / 2**20)
+            tracemalloc.stop()
+        else:
+            results += [wall, count_calls() - calls]
+    return tuple(results)
+
+
+def benchmark(rcf, jobs, schedds, user, cwd):
+    """
+    Benchmark every hot path on a fake queue of the given size
+    :return: list of (name, wall time, processes, peak MB)
+    """
+    def generate():
+        fakecondor.generate(jobs, schedds, user, cwd)
+        rcf.queue_cache.invalidate()
+        rcf.node_index.invalidate()
+
+    def reset():
+        rcf.queue_cache.invalidate()
+        rcf.node_index.invalidate()
+
+    generate()
+    output = rcf.RCFNavigator(rcf.CondorQuery(glob=True, user=user).command).get_output()
+    paths = [
+        ('parse', lambda: rcf.JobTable.parse(output), rcf.queue_cache.invalidate),
+        ('NodeChecker', lambda: rcf.NodeChecker(), reset),
+        ('NodeChecker (indexed)', lambda: rcf.NodeChecker(), rcf.queue_cache.invalidate),
+        ('LongKiller', lambda: rcf.LongKiller(1, 0, local=True), rcf.queue_cache.invalidate),
+        ('LongKiller.kill_bad_job', lambda: rcf.LongKiller(1, 0, local=True).kill_bad_job(), generate),
+        ('JobMonitor.check_queue', lambda: rcf.JobMonitor('nobody', glob=True).check_queue(), generate),
+    ]
+    return [(name,) + measure(func, setup) for name, func, setup in paths]
+
+
+def replay(rcf, user, cwd):
+    """
+    Run the read-only hot paths on a replayed capture
+    :return: dictionary of results to compare between versions
+    """
+    rcf.queue_cache.invalidate()
+    rcf.node_index.invalidate()
+    table = rcf.queue_cache.table(glob=True, user=user)
+    rows = table.in_dir(cwd)
+    return {'jobs': len(table),
+            'status': {str(status): count for status, count in sorted(table.count_status().items())},
+            'schedds': len(set(table.schedd)),
+            'cwd_jobs': len(rows),
+            'cwd_status': {str(status): count for status, count in sorted(table.count_status(rows).items())},
+            'node': rcf.NodeChecker().get_node()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark RCFNavigator against fake condor tools')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--schedds', type=int, default=3)
+    parser.add_argument('--user', default=os.environ.get('USER', 'starreco'))
+    parser.add_argument('--cwd', default='/star/data01/pwg/bench/run/', help='submission directory of the jobs')
+    parser.add_argument('--replay', help='captured condor_q -global -af:t output to replay')
+    parser.add_argument('--record', help='save the replay results to this json file')
+    parser.add_argument('--expect', help='compare the replay results with this json file')
+    args = parser.parse_args()
+
+    # RCFNavigator reads these when imported
+    os.environ['PATH'] = os.path.join(here, 'fake_condor') + os.pathsep + os.environ.get('PATH', '')
+    os.environ.setdefault('FAKE_CONDOR_DIR', tempfile.mkdtemp(prefix='fake_condor_'))
+    os.environ['USER'] = args.user
+    os.environ['PWD'] = args.cwd.rstrip('/')
+    os.environ['HOST'] = 'rcas6001'
+    import RCFNavigator as rcf
+    # keep the fake jobs out of the real node index and release counts
+    rcf.node_index.path = os.path.join(os.environ['FAKE_CONDOR_DIR'], 'nodes.json')
+    rcf.cache_dir = os.environ['FAKE_CONDOR_DIR']
+
+    if args.replay:
+        os.environ['FAKE_CONDOR_REPLAY'] = os.path.abspath(args.replay)
+        results = replay(rcf, args.user, args.cwd)
+        print(json.dumps(results, indent=2))
+        if args.record:
+            with open(args.record, 'w') as f:
+                json.dump(results, f, indent=2)
+        if args.expect:
+            with open(args.expect) as f:
+                expected = json.load(f)
+            if expected != results:
+                print('Replay results differ from', args.expect)
+                return 1
+        return 0
+
+    print(f'{"hot path":<26}{"jobs":>8}{"wall (s)":>10}{"procs":>7}{"peak (MB)":>11}')
+    for jobs in args.jobs:
+        for name, wall, procs, peak in benchmark(rcf, jobs, args.schedds, args.user, args.cwd):
+            print(f'{name:<26}{jobs:>8}{wall:>10.3f}{procs:>7}{peak:>11.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
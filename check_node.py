@@ -6,7 +6,9 @@ import os
 
 
 def main():
-    print(NodeChecker().get_node())
+    # every node with jobs of this directory, the one with the most jobs first
+    checker = NodeChecker()
+    print(' '.join(checker.get_nodes()) or checker.get_node())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for condor_q, condor_status, condor_rm, condor_release, condor_qedit and star-submit, so that RCFNavigator can be
+run and benchmarked without a live HTCondor pool. Put this directory first in $PATH and point
+$FAKE_CONDOR_DIR to a directory holding the fake queue, e.g.
+    python3 fake_condor/fakecondor.py generate --jobs 100000 --schedds 3 --cwd $PWD/
+    PATH=$PWD/fake_condor:$PATH FAKE_CONDOR_DIR=/tmp/fake_condor python3 check_node.py
+
+The queue is a tab-separated file with a header of attribute names ($FAKE_CONDOR_DIR/queue.tsv).
+Every call is appended to $FAKE_CONDOR_DIR/calls.log, which is how removals, releases and
+resubmissions (and the number of processes started) can be checked afterwards.
+condor_q and condor_qedit evaluate -constraint (see Expression) like a schedd would.
+Other knobs, all optional:
+    FAKE_CONDOR_REPLAY  file whose content condor_q prints instead of the queue (captured real output)
+    FAKE_CONDOR_DOWN    comma-separated schedds that fail with 'Failed to fetch ads'
+    FAKE_CONDOR_HUNG    comma-separated schedds that never answer
+    FAKE_CONDOR_DELAY   seconds condor_q sleeps per schedd it queries
+"""
+import argparse
+import contextlib
+import fcntl
+import os
+import random
+import re
+import sys
+import time
+
+attributes = ('ClusterId', 'ProcId', 'JobStatus', 'EnteredCurrentStatus', 'RemoteWallClockTime',
+              'GlobalJobId', 'RemoteHost', 'Iwd', 'Cmd', 'Args', 'Owner',
+              'HoldReason', 'HoldReasonCode', 'HoldReasonSubCode', 'NumHolds', 'RequestMemory')
+status_letter = {1: 'I', 2: 'R', 3: 'X', 4: 'C', 5: 'H', 6: '>', 7: 'S'}
+hold_reasons = [('Error from slot1@rcrs6001.rcf.bnl.gov: Job has gone over memory limit of 2048 megabytes.', 34, 0),
+                ('Error from slot1@rcrs6002.rcf.bnl.gov: Failed to execute: No such file or directory', 6, 2),
+                ('Transfer output files failure at execution point: Connection timed out', 12, 110)]
+
+
+def state_dir():
+    return os.environ.get('FAKE_CONDOR_DIR', '/tmp/fake_condor')
+
+
+def record(argv):
+    """
+    Append the call to calls.log
+    :param argv: the command line, program name first
+    """
+    os.makedirs(state_dir(), exist_ok=True)
+    with open(os.path.join(state_dir(), 'calls.log'), 'a') as log:
+        log.write(' '.join([os.path.basename(argv[0])] + argv[1:]) + '\n')
+
+
+@contextlib.contextmanager
+def locked():
+    """
+    Hold the queue for a read-modify-write, like a schedd does: removals and releases running at the
+    same time must not overwrite each other
+    """
+    os.makedirs(state_dir(), exist_ok=True)
+    with open(os.path.join(state_dir(), 'queue.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def load():
+    """
+    :return: list of jobs, each a dictionary of attribute -> string
+    """
+    with open(os.path.join(state_dir(), 'queue.tsv')) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        return [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f]
+
+
+def save(jobs):
+    path = os.path.join(state_dir(), 'queue.tsv')
+    with open(path + '.tmp', 'w') as f:
+        f.write('\t'.join(attributes) + '\n')
+        for job in jobs:
+            f.write('\t'.join(job.get(name, 'undefined') for name in attributes) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def generate(jobs, schedds=3, user=None, cwd=None, dirs=1, held=0.05, idle=0.2, max_days=3.0, seed=0):
+    """
+    Write a fake queue
+    :param jobs: number of jobs
+    :param schedds: number of schedds (rcas6001, rcas6002, ...)
+    :param user: owner of the jobs, default is $USER
+    :param cwd: submission directory of the jobs (with trailing '/'), default is $PWD/
+    :param dirs: number of submission directories, the first one is cwd, the others are siblings
+    :param held: fraction of held jobs
+    :param idle: fraction of idle jobs
+    :param max_days: running jobs started up to this many days ago
+    :param seed: random seed, the same arguments always give the same queue
+    """
+    rng = random.Random(seed)
+    user = user or os.environ.get('USER', 'starreco')
+    cwd = cwd or os.environ.get('PWD', '/tmp') + '/'
+    now = int(time.time())
+    queue = []
+    per_cluster = 1000
+    for n in range(jobs):
+        schedd = f'rcas{6001 + n % schedds}.rcf.bnl.gov'
+        cluster, proc = 1000 + n // per_cluster, n % per_cluster
+        directory = cwd if n % dirs == 0 else cwd.rstrip('/') + f'_{n % dirs}/'
+        sched = f'sched{cluster:08X}{"ABCDEF"[cluster % 6]}'
+        draw = rng.random()
+        status = 5 if draw < held else 1 if draw < held + idle else 2
+        job = {'ClusterId': str(cluster), 'ProcId': str(proc), 'JobStatus': str(status),
+               'EnteredCurrentStatus': str(now - int(rng.random() * max_days * 86400)),
+               'RemoteWallClockTime': '0.0', 'GlobalJobId': f'{schedd}#{cluster}.{proc}#{now - 86400 * 4}',
+               'RemoteHost': f'slot{proc % 32 + 1}@rcrs{6100 + proc % 200}.rcf.bnl.gov' if status == 2 else 'undefined',
+               'Iwd': directory.rstrip('/'), 'Cmd': f'{directory}{sched}_{proc}.csh', 'Args': 'undefined',
+               'Owner': user, 'NumHolds': '0', 'RequestMemory': '2048'}
+        if status == 5:
+            job['HoldReason'], code, subcode = hold_reasons[n % len(hold_reasons)]
+            job['HoldReasonCode'], job['HoldReasonSubCode'] = str(code), str(subcode)
+            job['NumHolds'] = '1'
+        queue.append(job)
+    os.makedirs(state_dir(), exist_ok=True)
+    save(queue)
+    open(os.path.join(state_dir(), 'calls.log'), 'w').close()
+
+
+def job_ids(args):
+    """
+    Split condor_rm/condor_release arguments into job ids, cluster ids and users
+    :return: (set of job ids, set of cluster ids, set of users, schedd name or None)
+    """
+    jobs, clusters, users, schedd = set(), set(), set(), None
+    args = iter(args)
+    for arg in args:
+        if arg == '-name':
+            schedd = next(args)
+        elif arg[:1].isdigit():
+            (jobs if '.' in arg else clusters).add(arg)
+        elif not arg.startswith('-'):
+            users.add(arg)
+    return jobs, clusters, users, schedd
+
+
+token_pattern = re.compile(r'\s*(?:(\d+\.\d*|\d+)|"((?:[^"\\]|\\.)*)"|([A-Za-z_]\w*)|(=\?=|=!=|==|!=|<=|>=|&&|\|\||[-+*/<>!(){},?:]))')
+
+
+class Expression:
+    """
+    Just enough of the ClassAd language for the constraints RCFNavigator writes: numbers, strings,
+    attributes, the usual operators (undefined is None and spreads like in condor), ?: and the functions
+    strcat, substr, member, ifThenElse, isUndefined and time, e.g.
+        Expression('JobStatus == 2 && Iwd =?= "/star/u/me/"').match(job)
+    The expression is compiled once into Python functions of the job, so a big queue stays quick.
+    """
+    functions = {
+        'strcat': lambda *args: None if None in args else ''.join(map(str, args)),
+        'substr': lambda string, offset, length=None: None if string is None else
+        string[int(offset):None if length is None else int(offset) + int(length)],
+        'member': lambda item, items: None if item is None else item in items,
+        'ifthenelse': lambda condition, yes, no: None if condition is None else (yes if condition else no),
+        'isundefined': lambda value: value is None,
+        'time': lambda: int(time.time()),
+    }
+    levels = [('||',), ('&&',), ('==', '!=', '=?=', '=!='), ('<', '<=', '>', '>='), ('+', '-'), ('*', '/')]
+
+    def __init__(self, text):
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            found = token_pattern.match(text, position)
+            if found is None:
+                raise ValueError(f'Cannot parse constraint at: {text[position:]}')
+            number, string, name, operator = found.groups()
+            if number is not None:
+                self.tokens.append(('value', float(number) if '.' in number else int(number)))
+            elif string is not None:
+                self.tokens.append(('value', re.sub(r'\\(.)', r'\1', string)))
+            elif name is not None:
+                self.tokens.append(('name', name))
+            else:
+                self.tokens.append(('op', operator))
+            position = found.end()
+        self.position = 0
+        # the compiled parts that do not depend on the job
+        self.constants = set()
+        self.evaluate = self.ternary()
+        if self.position != len(self.tokens):
+            raise ValueError(f'Unexpected {self.peek()[1]} in constraint')
+
+    def match(self, job):
+        """
+        :param job: dictionary of attribute -> string, as in the queue file
+        :return: whether the expression is true for the job
+        """
+        return self.evaluate(job) is True
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else ('end', None)
+
+    def take(self, operator=None):
+        kind, value = self.peek()
+        if kind == 'end' or (operator is not None and (kind, value) != ('op', operator)):
+            raise ValueError(f'Expected {operator or "more"} in constraint')
+        self.position += 1
+        return kind, value
+
+    def constant(self, value):
+        function = lambda job: value
+        self.constants.add(function)
+        return function
+
+    def items(self, closing):
+        """
+        Compile a comma separated list up to the closing bracket
+        """
+        items = []
+        while self.peek() != ('op', closing):
+            items.append(self.ternary())
+            if self.peek() == ('op', ','):
+                self.take()
+        self.take(closing)
+        return items
+
+    def ternary(self):
+        condition = self.binary(0)
+        if self.peek() != ('op', '?'):
+            return condition
+        self.take()
+        yes = self.ternary()
+        self.take(':')
+        no = self.ternary()
+
+        def choose(job):
+            value = condition(job)
+            return None if value is None else (yes(job) if value else no(job))
+        return choose
+
+    def binary(self, level):
+        if level == len(self.levels):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.peek()[0] == 'op' and self.peek()[1] in self.levels[level]:
+            operator = self.take()[1]
+            left = self.combine(operator, left, self.binary(level + 1))
+        return left
+
+    @staticmethod
+    def combine(operator, left, right):
+        apply = Expression.apply
+        if operator in ('&&', '||'):
+            decided = operator == '||'
+
+            # without looking at the right side when the left one decides
+            def logic(job):
+                value = left(job)
+                return decided if value is decided else apply(operator, value, right(job))
+            return logic
+        return lambda job: apply(operator, left(job), right(job))
+
+    @staticmethod
+    def apply(operator, left, right):
+        if operator == '=?=':
+            return type(left) == type(right) and left == right or (left is None and right is None)
+        if operator == '=!=':
+            return not Expression.apply('=?=', left, right)
+        if operator == '||':
+            return True if left is True or right is True else (None if None in (left, right) else False)
+        if operator == '&&':
+            return False if left is False or right is False else (None if None in (left, right) else True)
+        if left is None or right is None:
+            return None
+        if isinstance(left, str) and isinstance(right, str) and operator in ('==', '!='):
+            # == is case insensitive for strings
+            left, right = left.lower(), right.lower()
+        return {'==': lambda: left == right, '!=': lambda: left != right, '<': lambda: left < right,
+                '<=': lambda: left <= right, '>': lambda: left > right, '>=': lambda: left >= right,
+                '+': lambda: left + right, '-': lambda: left - right, '*': lambda: left * right,
+                '/': lambda: left / right}[operator]()
+
+    def unary(self):
+        kind, value = self.take()
+        if (kind, value) == ('op', '!'):
+            operand = self.unary()
+            return lambda job: None if operand(job) is None else not operand(job)
+        if (kind, value) == ('op', '-'):
+            operand = self.unary()
+            return lambda job: None if operand(job) is None else -operand(job)
+        if (kind, value) == ('op', '('):
+            result = self.ternary()
+            self.take(')')
+            return result
+        if (kind, value) == ('op', '{'):
+            items = self.items('}')
+            if all(item in self.constants for item in items):
+                values = [item({}) for item in items]
+                return self.constant(values)
+            return lambda job: [item(job) for item in items]
+        if kind == 'value':
+            return self.constant(value)
+        if kind == 'name':
+            name = value.lower()
+            if self.peek() == ('op', '('):
+                self.take()
+                args = self.items(')')
+                function = self.functions[name]
+                if name == 'member' and len(args) == 2 and args[1] in self.constants:
+                    # the list is the same for every job, look it up in a set
+                    members = set(args[1]({}))
+                    return lambda job: function(args[0](job), members)
+                return lambda job: function(*(arg(job) for arg in args))
+            if name in ('true', 'false'):
+                return lambda job: name == 'true'
+            if name == 'undefined':
+                return lambda job: None
+            # attribute names are case insensitive, the queue file has the usual spelling
+            key = {attribute.lower(): attribute for attribute in attributes}.get(name, value)
+            return lambda job: typed(job.get(key, 'undefined'))
+        raise ValueError(f'Unexpected {value} in constraint')
+
+
+def typed(field):
+    """
+    :param field: attribute value as a string from the queue file
+    :return: None for undefined, int or float for numbers, the string otherwise
+    """
+    if field == 'undefined':
+        return None
+    for kind in (int, float):
+        try:
+            return kind(field)
+        except ValueError:
+            pass
+    return field
+
+
+def on_schedd(job, schedd):
+    return schedd is None or job['GlobalJobId'].split('#')[0].split('.')[0] == schedd.split('.')[0]
+
+
+def matches(job, jobs, clusters, users, schedd):
+    if not on_schedd(job, schedd):
+        return False
+    return (f'{job["ClusterId"]}.{job["ProcId"]}' in jobs or job['ClusterId'] in clusters
+            or job['Owner'] in users)
+
+
+def condor_q(argv):
+    record(argv)
+    replay = os.environ.get('FAKE_CONDOR_REPLAY')
+    if replay:
+        with open(replay, 'rb') as f:
+            sys.stdout.buffer.write(f.read())
+        return 0
+    glob, schedd, user, af, separator, constraint = False, None, None, None, ' ', None
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == '-global':
+            glob = True
+        elif arg == '-name':
+            schedd = next(args)
+        elif arg.startswith('-af'):
+            af = []
+            separator = '\t' if ':' in arg and 't' in arg.split(':')[1] else ' '
+        elif arg in ('-constraint', '-const'):
+            constraint = Expression(next(args))
+        elif arg.startswith('-'):
+            # options with a value we do not look at
+            if arg == '-limit':
+                next(args)
+        elif af is not None:
+            af.append(arg)
+        else:
+            user = arg
+
+    local = os.environ.get('HOST', 'rcas6001').split('.')[0]
+    down = {name.split('.')[0] for name in os.environ.get('FAKE_CONDOR_DOWN', '').split(',') if name}
+    hung = {name.split('.')[0] for name in os.environ.get('FAKE_CONDOR_HUNG', '').split(',') if name}
+    delay = float(os.environ.get('FAKE_CONDOR_DELAY', 0))
+    by_schedd = {}
+    for job in load():
+        by_schedd.setdefault(job['GlobalJobId'].split('#')[0], []).append(job)
+    wanted = [name for name in sorted(by_schedd)
+              if glob or name.split('.')[0] == (schedd or local).split('.')[0]]
+
+    out = sys.stdout
+    for name in wanted:
+        time.sleep(delay)
+        while name.split('.')[0] in hung:
+            time.sleep(60)
+        if name.split('.')[0] in down:
+            sys.stderr.write(f'-- Failed to fetch ads from: <130.199.1.1:9618> : {name}\n')
+            continue
+        jobs = [job for job in by_schedd[name] if (user is None or job['Owner'] == user)
+                and (constraint is None or constraint.match(job))]
+        if af is not None:
+            for job in jobs:
+                out.write(separator.join(job.get(attribute, 'undefined') for attribute in af) + '\n')
+            continue
+        # the human-readable format, for eyes and for replay captures
+        out.write(f'\n\n-- Schedd: {name} : <130.199.1.1:9618?... @ 03/26/24 10:00:00\n')
+        out.write(' ID          OWNER            SUBMITTED     RUN_TIME ST PRI SIZE CMD\n')
+        now = time.time()
+        for job in jobs:
+            run_time = int(float(job['RemoteWallClockTime']))
+            if job['JobStatus'] == '2':
+                run_time += int(now - int(job['EnteredCurrentStatus']))
+            days, rest = divmod(run_time, 86400)
+            out.write(f'{job["ClusterId"]}.{job["ProcId"]:<8} {job["Owner"]:<16} 3/26 10:00 '
+                      f'{days:>3}+{rest // 3600:02d}:{rest % 3600 // 60:02d}:{rest % 60:02d} '
+                      f'{status_letter[int(job["JobStatus"])]}  0    0.0 {os.path.basename(job["Cmd"])}\n')
+    return 0
+
+
+def condor_status(argv):
+    """
+    Only 'condor_status -schedd -af Name': the schedds of the fake queue, those without jobs of anybody
+    are not known. Fails when replaying, so that a replayed condor_q -global is used as it is
+    """
+    record(argv)
+    if os.environ.get('FAKE_CONDOR_REPLAY'):
+        sys.stderr.write('Failed to fetch ads from collector\n')
+        return 1
+    for name in sorted({job['GlobalJobId'].split('#')[0] for job in load()}):
+        print(name)
+    return 0
+
+
+def condor_rm(argv):
+    record(argv)
+    jobs, clusters, users, schedd = job_ids(argv[1:])
+    kept = []
+    found_jobs, found_clusters = set(), set()
+    with locked():
+        for job in load():
+            if matches(job, jobs, clusters, users, schedd):
+                found_jobs.add(f'{job["ClusterId"]}.{job["ProcId"]}')
+                found_clusters.add(job['ClusterId'])
+            else:
+                kept.append(job)
+        save(kept)
+    for cluster in sorted(clusters):
+        if cluster in found_clusters:
+            print(f'All jobs in cluster {cluster} have been marked for removal')
+        else:
+            sys.stderr.write(f"Couldn't find/remove all jobs in cluster {cluster}\n")
+    for job in sorted(jobs):
+        if job in found_jobs:
+            print(f'Job {job} marked for removal')
+        else:
+            sys.stderr.write(f'Job {job} not found\n')
+    for user in sorted(users):
+        print(f'All jobs of user "{user}" have been marked for removal')
+    return 0 if (jobs | clusters | users) and not (jobs - found_jobs) and not (clusters - found_clusters) else 1
+
+
+def condor_release(argv):
+    record(argv)
+    jobs, clusters, users, schedd = job_ids(argv[1:])
+    released = []
+    with locked():
+        queue = load()
+        for job in queue:
+            if job['JobStatus'] == '5' and matches(job, jobs, clusters, users, schedd):
+                job['JobStatus'] = '1'
+                job['EnteredCurrentStatus'] = str(int(time.time()))
+                released.append(f'{job["ClusterId"]}.{job["ProcId"]}')
+        save(queue)
+    for user in sorted(users):
+        print(f'All jobs of user "{user}" have been released')
+    for cluster in sorted(clusters):
+        print(f'All jobs in cluster {cluster} have been released')
+    for job in sorted(released):
+        if job in jobs:
+            print(f'Job {job} released')
+    return 0
+
+
+def condor_qedit(argv):
+    """
+    Only 'condor_qedit [-name schedd] -constraint expression attribute value ...'
+    """
+    record(argv)
+    schedd, constraint, edits = None, '', []
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == '-name':
+            schedd = next(args)
+        elif arg == '-constraint':
+            constraint = next(args)
+        else:
+            edits.append((arg, next(args)))
+    constraint = Expression(constraint)
+    edited = 0
+    with locked():
+        queue = load()
+        for job in queue:
+            if on_schedd(job, schedd) and constraint.match(job):
+                job.update(edits)
+                edited += 1
+        save(queue)
+    for name, value in edits:
+        print(f'Set attribute "{name}" for {edited} matching jobs.')
+    return 0 if edited else 1
+
+
+def star_submit(argv):
+    record(argv)
+    print('Using default settings')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a fake condor queue')
+    parser.add_argument('action', choices=['generate'])
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--schedds', type=int, default=3)
+    parser.add_argument('--user')
+    parser.add_argument('--cwd', help='submission directory, with trailing /')
+    parser.add_argument('--dirs', type=int, default=1, help='number of submission directories')
+    parser.add_argument('--held', type=float, default=0.05)
+    parser.add_argument('--idle', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.jobs, args.schedds, args.user, args.cwd, args.dirs, args.held, args.idle, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fast command line front end of RCFNavigator, replacing check_node.py, kill_long.py and get_date.py:
+    rcfnav.py node              # nodes running the jobs of this directory
+    rcfnav.py count             # running/idle/held jobs of this directory
+    rcfnav.py long 1 0          # jobs of this directory running for more than 1 day 0 hours
+    rcfnav.py long 1 0 --kill   # ... and kill them
+    rcfnav.py date              # e.g. Oct_17
+The answers come from the rcfnavd.py daemon when it runs on this node (no condor_q, no import of
+RCFNavigator), otherwise the same query is run directly.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def socket_path():
+    """
+    :return: path of the daemon socket, $RCFNAV_SOCKET or one per user in the temporary directory
+             (the home directory may be on NFS, where Unix sockets do not work across nodes)
+    """
+    return os.environ.get('RCFNAV_SOCKET') or f'/tmp/rcfnav-{os.getuid()}/rcfnavd.sock'
+
+
+# commands that change the queue, they must not run a second time when the answer of the daemon is lost
+mutating = {'kill'}
+
+
+def ask(request, timeout=600):
+    """
+    Send a request to the daemon, or answer it directly when the daemon is not running
+    :param request: dictionary with the query, see rcfnavd.answer()
+    :param timeout: seconds to wait for the daemon
+    :return: the answer dictionary
+    """
+    sent = False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path())
+            sent = True
+            client.sendall(json.dumps(request).encode() + b'\n')
+            with client.makefile('rb') as reply:
+                return json.loads(reply.readline())
+    except (OSError, ValueError) as error:
+        if sent and request.get('command') in mutating:
+            # the daemon may have done it already
+            return {'error': f'No answer from rcfnavd.py ({error or type(error).__name__}), '
+                             f'it may have run {request["command"]} already. Check again before retrying'}
+        # no daemon (or a dead one), do it ourselves
+        import rcfnavd
+        return rcfnavd.answer(request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the RCF job queue, through rcfnavd.py if it is running')
+    parser.add_argument('--dir', help='directory of the jobs, default is the current one')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('node', help='nodes running the jobs, most jobs first')
+    commands.add_parser('count', help='number of jobs by status')
+    long = commands.add_parser('long', help='jobs running for too long')
+    long.add_argument('days', type=int, nargs='?', default=1)
+    long.add_argument('hours', type=int, nargs='?', default=0)
+    long.add_argument('--kill', action='store_true', help='kill them')
+    commands.add_parser('date', help='current date, e.g. Oct_17')
+    args = parser.parse_args()
+
+    cwd = os.path.abspath(args.dir) if args.dir else os.environ.get('PWD') or os.getcwd()
+    request = {'command': args.command, 'cwd': cwd.rstrip('/') + '/'}
+    if args.command == 'long':
+        request.update(days=args.days, hours=args.hours)
+    reply = ask(request)
+    if 'error' in reply:
+        print(reply['error'], file=sys.stderr)
+        return 1
+
+    if args.command == 'node':
+        print(' '.join(reply['nodes']) or os.environ.get('HOST'))
+    elif args.command == 'count':
+        print(' '.join(f'{status}: {count}' for status, count in reply['counts'].items()))
+    elif args.command == 'date':
+        print(reply['date'])
+    elif args.command == 'long':
+        print(f'{len(reply["jobs"])} jobs running for more than {reply["threshold"]:g} hours')
+        if reply['jobs'] and not args.kill:
+            print(' '.join(job_id for job_id, _ in reply['jobs']))
+        if reply['jobs'] and args.kill:
+            nodes = reply['nodes']
+            if nodes and os.environ.get('HOST') not in nodes:
+                print(f'You are not on the right node! Go to {" or ".join(nodes)}.')
+                if input("Kill jobs anyway? (y/n)") != 'y':
+                    return 0
+            reply = ask(dict(request, command='kill'))
+            if 'error' in reply:
+                print(reply['error'], file=sys.stderr)
+                return 1
+            print(reply['output'], end='')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Optional daemon keeping one refreshed condor_q snapshot of the user and answering the queries of
+rcfnav.py (node, count, long, kill, date) over a Unix socket, so they do not each start condor_q.
+Run it once per interactive node, e.g.
+    nohup python3 rcfnavd.py --interval 60 > ~/rcfnavd.log 2>&1 &
+The protocol is one JSON request per connection, answered with one JSON line, e.g.
+    {"command": "node", "cwd": "/star/data01/pwg/me/run/"}  ->  {"nodes": ["rcas6006"]}
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from RCFNavigator import JobStatus, LongKiller, NodeChecker, queue_cache
+from rcfnav import socket_path
+
+status_names = {JobStatus.RUNNING: 'running', JobStatus.IDLE: 'idle', JobStatus.HELD: 'held'}
+# kills change the queue, one at a time
+kill_lock = threading.Lock()
+
+
+def answer(request, cache=None):
+    """
+    Answer one query, used by the daemon and by rcfnav.py when there is no daemon
+    :param request: dictionary with 'command' and 'cwd' (with trailing '/'), 'days' and 'hours' for long/kill
+    :param cache: QueueCache to take the queue from, default is the shared one
+    :return: the answer dictionary, with 'error' if it failed
+    """
+    cache = cache or queue_cache
+    command = request.get('command')
+    cwd = request.get('cwd')
+    try:
+        if command == 'date':
+            # same as DateGetter, without running date
+            return {'date': f'{time.strftime("%b")}_{time.localtime().tm_mday}'}
+        if command == 'node':
+            return {'nodes': NodeChecker(cache, cwd).get_nodes()}
+        if command == 'count':
+            table = cache.table(glob=True, user=os.environ.get('USER'))
+            counts = table.count_status(table.in_dir(cwd))
+            return {'counts': {name: counts.get(status, 0) for status, name in status_names.items()}}
+        if command == 'long':
+            killer = LongKiller(request.get('days', 1), request.get('hours', 0), cache=cache, cwd=cwd)
+            return {'threshold': killer.hour_threshold, 'jobs': list(zip(killer.bad_id_list, killer.bad_sched_list)),
+                    'nodes': NodeChecker(cache, cwd).get_nodes()}
+        if command == 'kill':
+            with kill_lock:
+                killer = LongKiller(request.get('days', 1), request.get('hours', 0), cache=cache, cwd=cwd)
+                output = io.StringIO()
+                # the client already checked the node
+                with contextlib.redirect_stdout(output):
+                    results = killer.kill_bad_job(check_node=False)
+            return {'output': output.getvalue(), 'removed': [job_id for job_id, ok in results.items() if ok],
+                    'failed': [job_id for job_id, ok in results.items() if not ok]}
+        return {'error': f'Unknown command {command}'}
+    except Exception as error:
+        return {'error': f'{type(error).__name__}: {error}'}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # only checking that we are alive
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            reply = {'error': 'Bad request'}
+        else:
+            reply = answer(request)
+        with contextlib.suppress(BrokenPipeError):
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class NavigatorDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The socket server, each request is answered in its own thread from the shared queue cache
+    """
+    daemon_threads = True
+
+    def __init__(self, path, interval=60):
+        """
+        :param path: path of the Unix socket
+        :param interval: seconds between two condor_q
+        """
+        self.path = path
+        self.interval = interval
+        self.exit = threading.Event()
+        # a slow condor_q must not leave the clients without a snapshot
+        queue_cache.ttl = 3 * interval
+        super().__init__(path, RequestHandler)
+        os.chmod(path, 0o600)
+
+    def refresh(self):
+        """
+        Keep the snapshot fresh until the server stops
+        """
+        user = os.environ.get('USER')
+        while not self.exit.is_set():
+            start = time.monotonic()
+            table = queue_cache.refresh(glob=True, user=user)
+            print(f'{time.strftime("%H:%M:%S")} {len(table)} jobs in {time.monotonic() - start:.1f} s'
+                  + (f', {table.error.strip()}' if table.error.strip() else ''), flush=True)
+            self.exit.wait(self.interval)
+
+    def serve(self):
+        threading.Thread(target=self.refresh, daemon=True).start()
+        try:
+            self.serve_forever()
+        finally:
+            self.exit.set()
+            self.server_close()
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the RCF job queue to rcfnav.py over a Unix socket')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between two condor_q')
+    parser.add_argument('--socket', default=socket_path(), help='path of the socket')
+    args = parser.parse_args()
+
+    directory = os.path.dirname(args.socket)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.stat(directory).st_uid != os.getuid():
+        print(f'{directory} belongs to someone else', file=sys.stderr)
+        return 1
+    if os.path.exists(args.socket):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(args.socket)
+            print(f'rcfnavd is already running on {args.socket}', file=sys.stderr)
+            return 1
+        except OSError:
+            # left over by a daemon that died
+            os.remove(args.socket)
+
+    server = NavigatorDaemon(args.socket, args.interval)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f'rcfnavd listening on {args.socket}', flush=True)
+    with contextlib.suppress(KeyboardInterrupt):
+        server.serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_dir = os.path.join(root, 'fake_condor')
+sys.path[:0] = [root, fake_dir]
+# RCFNavigator reads these when it is imported: a home for its cache, and a user and host like on RCF.
+# The condor commands are the fake ones, see fake_condor/fakecondor.py
+home = tempfile.mkdtemp(prefix='rcfnav-tests-')
+os.environ.update(HOME=home, PWD=home, USER='me', HOST='rcas6001',
+                  PATH=fake_dir + os.pathsep + os.environ.get('PATH', ''))
+
+
+class FakeCondor:
+    """
+    The fake queue of one test
+    """
+    def __init__(self, path):
+        self.path = path
+        self.cwd = os.path.join(path, 'run', '')
+
+    def generate(self, jobs, **options):
+        """
+        Write a new queue of the user 'me', submitted from self.cwd (and its siblings run_1, ... with dirs)
+        :param jobs: number of jobs
+        :param options: see fakecondor.generate
+        """
+        import fakecondor
+        options.setdefault('cwd', self.cwd)
+        fakecondor.generate(jobs, user='me', **options)
+
+    def calls(self, program=None):
+        """
+        :param program: only the calls of this program, e.g. 'condor_q'
+        :return: the command lines run so far
+        """
+        try:
+            with open(os.path.join(self.path, 'calls.log')) as log:
+                calls = log.read().splitlines()
+        except OSError:
+            return []
+        return [call for call in calls if program is None or call.split()[0] == program]
+
+
+@pytest.fixture
+def condor(tmp_path, monkeypatch):
+    """
+    An empty fake queue, and the caches of RCFNavigator forgotten
+    """
+    monkeypatch.setenv('FAKE_CONDOR_DIR', str(tmp_path))
+    import RCFNavigator
+    import AsyncNavigator
+    monkeypatch.setattr(RCFNavigator.CondorQuery, 'schedd_list', (0, []))
+    monkeypatch.setattr(RCFNavigator, 'node_index', RCFNavigator.NodeIndex(str(tmp_path / 'nodes.json')))
+    monkeypatch.setattr(AsyncNavigator, 'node_index', RCFNavigator.node_index)
+    RCFNavigator.queue_cache.invalidate()
+    AsyncNavigator.queue_cache.invalidate()
+    return FakeCondor(str(tmp_path))
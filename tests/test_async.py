@@ -0,0 +1,121 @@
+import asyncio
+import os
+import threading
+import time
+import AsyncNavigator
+from AsyncNavigator import AsyncNavigator as Navigator, AsyncJobMonitor, AsyncQueueCache, query, check_node, find_long
+from RCFNavigator import CondorQuery, LongKiller, MissingTracker
+
+
+def jobs(table):
+    return sorted(zip(table.schedd, table.cluster, table.proc))
+
+
+def run(coroutine, timeout=60):
+    """
+    Run a coroutine in a new event loop on its own thread, so a blocked loop fails the test instead of hanging it
+    :return: what the coroutine returned
+    """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(asyncio.run(coroutine)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'the event loop is blocked'
+    return result[0]
+
+
+def test_navigator():
+    navigator = run(Navigator(['sh', '-c', 'echo out; echo err >&2; exit 2']).run())
+    assert (navigator.get_output(), navigator.get_error(), navigator.get_process().returncode) == \
+        (b'out\n', b'err\n', 2)
+
+
+def test_timeout():
+    start = time.monotonic()
+    navigator = run(Navigator('echo started; sleep 30', timeout=0.3).run())
+    assert time.monotonic() - start < 5
+    assert navigator.timed_out
+    assert navigator.get_error().endswith(b'Timed out after 0.3 s\n')
+
+
+def test_cancel():
+    async def cancel():
+        navigator = Navigator('sleep 30')
+        task = asyncio.ensure_future(navigator.run())
+        await asyncio.sleep(0.3)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return navigator
+    navigator = run(cancel())
+    # killed, not left behind
+    assert navigator.get_process().returncode is not None
+
+
+def test_query(condor, monkeypatch):
+    condor.generate(600, schedds=3, dirs=2)
+    monkeypatch.setenv('FAKE_CONDOR_DOWN', 'rcas6003')
+    table = run(query(glob=True, user='me', constraint=LongKiller.query(condor.cwd, 12),
+                      attributes=LongKiller.attributes))
+    CondorQuery.schedd_list = (0, [])
+    expected = CondorQuery(glob=True, user='me', constraint=LongKiller.query(condor.cwd, 12),
+                           attributes=LongKiller.attributes).table()
+    assert jobs(table) == jobs(expected) and len(table) > 0
+    assert table.unreachable == expected.unreachable == ['rcas6003.rcf.bnl.gov']
+    assert table.covered() == {'rcas6001', 'rcas6002'}
+
+
+def test_fetch_shared(condor, monkeypatch):
+    condor.generate(300)
+    monkeypatch.setenv('FAKE_CONDOR_DELAY', '0.5')
+    cache = AsyncQueueCache()
+
+    async def fetch_all():
+        # tasks of the loop and a thread ask for the same snapshot at the same time
+        thread = asyncio.to_thread(cache.table, False, 'me')
+        return await asyncio.gather(thread, *(cache.fetch(user='me') for _ in range(5)))
+    tables = run(fetch_all())
+    assert len(condor.calls('condor_q')) == 1
+    assert all(table is tables[0] for table in tables)
+
+
+def test_check_node_and_find_long(condor):
+    condor.generate(900, schedds=3, dirs=3)
+    checker = run(check_node(cwd=condor.cwd))
+    assert checker.get_nodes() == ['rcas6001']
+    killer = run(find_long(0, 12, local=True, cwd=condor.cwd))
+    expected = LongKiller(0, 12, local=True, cwd=condor.cwd)
+    assert sorted(killer.bad_id_list) == sorted(expected.bad_id_list) and killer.bad_id_list
+
+
+def test_monitors(condor, tmp_path):
+    # one monitor per directory, all glob on the shared cache, and kills on the way. Meanwhile something
+    # else changes the queue, so the cache is dropped while the monitors are querying
+    condor.generate(3000, schedds=3, dirs=3, held=0)
+    monitors = []
+    for name in ('run', 'run_1', 'run_2'):
+        cwd = str(tmp_path / name) + '/'
+        os.makedirs(cwd + 'out', exist_ok=True)
+        tracker = MissingTracker(cwd + 'out', script_dir=cwd, state_file=str(tmp_path / f'{name}.json'))
+        monitors.append(AsyncJobMonitor('me@bnl.gov', 1, 6, glob=True, cwd=cwd, tracker=tracker))
+
+    async def cycles():
+        stop = threading.Event()
+
+        def invalidate():
+            while not stop.wait(0.05):
+                AsyncNavigator.queue_cache.invalidate()
+        changes = threading.Thread(target=invalidate)
+        changes.start()
+        try:
+            results = []
+            for _ in range(3):
+                results.append(await asyncio.gather(*(monitor.task() for monitor in monitors)))
+            return results
+        finally:
+            stop.set()
+            changes.join()
+    assert run(cycles(), timeout=120) == [[False] * 3] * 3
+    assert [monitor.node for monitor in monitors] == ['rcas6001', 'rcas6002', 'rcas6003']
+    # the long jobs of the local directory were killed, the other directories are seen but left alone
+    assert condor.calls('condor_rm')
+    assert 0 < monitors[0].count_all < 1000 and [monitor.count_all for monitor in monitors[1:]] == [1000] * 2
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+import pytest
+from RCFNavigator import QueueCache, CondorQuery, LongKiller, JobMonitor
+
+
+def jobs(table):
+    return sorted(zip(table.schedd, table.cluster, table.proc))
+
+
+def test_one_query_for_all(condor, monkeypatch):
+    condor.generate(300)
+    monkeypatch.setenv('FAKE_CONDOR_DELAY', '0.5')
+    cache = QueueCache()
+    tables = []
+    threads = [threading.Thread(target=lambda: tables.append(cache.table(user='me'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(condor.calls('condor_q')) == 1
+    assert all(table is tables[0] for table in tables) and len(tables[0]) == 100
+    # and kept for the next one
+    assert cache.table(user='me') is tables[0]
+
+
+def test_invalidate_while_querying(condor, monkeypatch):
+    condor.generate(300)
+    monkeypatch.setenv('FAKE_CONDOR_DELAY', '0.5')
+    cache = QueueCache()
+    query = threading.Thread(target=cache.table, kwargs={'user': 'me'})
+    query.start()
+    time.sleep(0.2)
+    # e.g. condor_rm, the answer of the running query is outdated
+    cache.invalidate()
+    query.join()
+    assert cache.peek(user='me') is None
+    cache.table(user='me')
+    assert len(condor.calls('condor_q')) == 2
+
+
+def test_failed_query(condor, monkeypatch):
+    condor.generate(300)
+    cache = QueueCache()
+    path = os.environ['PATH']
+    monkeypatch.setenv('PATH', '/nonexistent')
+    with pytest.raises(OSError):
+        cache.table(user='me')
+    # not kept, the next one asks again
+    monkeypatch.setenv('PATH', path)
+    assert len(cache.table(user='me')) == 100
+
+
+def test_narrower_constraint(condor):
+    condor.generate(3000, dirs=3)
+    cache = QueueCache()
+    directory = cache.table(user='me', constraint=LongKiller.query(condor.cwd), attributes=JobMonitor.attributes)
+    assert len(condor.calls('condor_q')) == 1
+    # the long jobs of the directory are among those
+    long = cache.table(user='me', constraint=LongKiller.query(condor.cwd, 12), attributes=LongKiller.attributes)
+    assert len(condor.calls('condor_q')) == 1
+    assert 0 < len(long) < len(directory)
+    asked = CondorQuery(user='me', constraint=LongKiller.query(condor.cwd, 12), attributes=LongKiller.attributes)
+    assert jobs(long) == jobs(asked.table())
+    # but not the other way round
+    cache.table(user='me', constraint=LongKiller.query(condor.cwd), attributes=JobMonitor.attributes + ('Args',))
+    assert len(condor.calls('condor_q')) == 3
+
+
+def test_global_answers_local(condor, monkeypatch):
+    condor.generate(300, schedds=3)
+    cache = QueueCache()
+    whole = cache.table(glob=True, user='me')
+    calls = len(condor.calls('condor_q'))
+    local = cache.table(user='me', constraint=LongKiller.query(condor.cwd), attributes=LongKiller.attributes)
+    assert len(condor.calls('condor_q')) == calls
+    assert set(local.schedd) == {'rcas6001.rcf.bnl.gov'} and len(local) < len(whole)
+    # not when the local schedd did not answer
+    monkeypatch.setenv('FAKE_CONDOR_DOWN', 'rcas6001')
+    cache.invalidate()
+    CondorQuery.schedd_list = (0, [])
+    cache.table(glob=True, user='me')
+    calls = len(condor.calls('condor_q'))
+    cache.table(user='me')
+    assert len(condor.calls('condor_q')) == calls + 1
@@ -0,0 +1,143 @@
+import socket
+import subprocess
+import threading
+import time
+import pytest
+
+paramiko = pytest.importorskip('paramiko')
+pytest.importorskip('fabric')
+from CheckRCF import RCFInterface
+from RCFNavigator import RCFNavigator, CondorQuery
+
+
+class Server(paramiko.ServerInterface):
+    """
+    A minimal sshd: any key is accepted and commands run locally with /bin/sh
+    """
+    def __init__(self, processes):
+        self.processes = processes
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.processes.append(process)
+
+        def pump(stream, send):
+            for data in iter(lambda: stream.read1(65536), b''):
+                send(data)
+
+        def serve():
+            pumps = [threading.Thread(target=pump, args=(process.stdout, channel.sendall)),
+                     threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr))]
+            for thread in pumps:
+                thread.start()
+            for thread in pumps:
+                thread.join()
+            channel.send_exit_status(process.wait())
+            channel.shutdown_write()
+            channel.close()
+        threading.Thread(target=serve, daemon=True).start()
+        return True
+
+
+@pytest.fixture(scope='module')
+def sshd(tmp_path_factory):
+    """
+    :return: (address of the server as a node name, the processes it started, number of connections)
+    """
+    key = paramiko.RSAKey.generate(2048)
+    host_key = paramiko.RSAKey.generate(2048)
+    key_file = tmp_path_factory.mktemp('ssh') / 'id_rsa'
+    key.write_private_key_file(str(key_file))
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    processes, transports = [], []
+
+    def accept():
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.start_server(server=Server(processes))
+            transports.append(transport)
+    threading.Thread(target=accept, daemon=True).start()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(RCFInterface, 'key_dir', str(key_file))
+        yield f'127.0.0.1:{server.getsockname()[1]}', processes, transports
+    server.close()
+
+
+@pytest.fixture
+def interface(sshd):
+    node, _, _ = sshd
+    interface = RCFInterface(node, gateway=False)
+    yield interface
+    interface.close()
+
+
+def test_run(interface, sshd):
+    _, _, transports = sshd
+    connections = len(transports)
+    assert interface.run('echo out; echo err >&2; exit 3') == (3, b'out\n', b'err\n')
+    assert interface.run('echo again') == (0, b'again\n', b'')
+    # one connection, a channel per command
+    assert len(transports) == connections + 1
+
+
+def test_large_output(interface):
+    # both streams at once, neither may block the other
+    code, out, err = interface.run('head -c 3000000 /dev/zero; head -c 1000000 /dev/zero >&2; echo end')
+    assert (code, len(out), len(err)) == (0, 3000004, 1000000)
+
+
+def test_concurrent(interface):
+    start = time.monotonic()
+    commands = [threading.Thread(target=interface.run, args=('sleep 0.5',)) for _ in range(interface.channels)]
+    for thread in commands:
+        thread.start()
+    for thread in commands:
+        thread.join()
+    assert time.monotonic() - start < 0.5 * interface.channels / 2
+
+
+def test_timeout(interface, sshd):
+    _, processes, _ = sshd
+    start = time.monotonic()
+    code, out, err = interface.run('echo started; sleep 30; echo never', timeout=0.5)
+    assert time.monotonic() - start < 5
+    assert code == -1 and out == b'started\n' and err.endswith(b'Timed out after 0.5 s\n')
+    # and killed on the node as well
+    assert processes[-1].wait(5) in RCFInterface.timeout_codes
+
+
+def test_run_many(interface, sshd):
+    node, _, _ = sshd
+    results = interface.run_many('echo hello', [node, '127.0.0.1:1'])
+    assert results[node] == (0, b'hello\n', b'')
+    code, out, err = results['127.0.0.1:1']
+    assert code == -1 and out == b'' and err
+
+
+def test_navigator(interface, condor, monkeypatch):
+    condor.generate(300, schedds=3, dirs=3)
+    local = CondorQuery(glob=True, user='me').table()
+    monkeypatch.setattr(RCFNavigator, 'remote', interface)
+    CondorQuery.schedd_list = (0, [])
+    calls = len(condor.calls('condor_q'))
+    remote = CondorQuery(glob=True, user='me').table()
+    assert len(condor.calls('condor_q')) == calls + 3
+    assert sorted(map(tuple, zip(remote.schedd, remote.cluster, remote.proc))) == \
+        sorted(map(tuple, zip(local.schedd, local.cluster, local.proc)))
+    assert RCFNavigator(['echo', 'over ssh']).get_output() == b'over ssh\n'
@@ -0,0 +1,106 @@
+import threading
+import time
+from RCFNavigator import JobLogTailer, JobMonitor, JobStatus
+
+texts = {0: 'Job submitted from host: <130.199.1.1:9618>', 1: 'Job executing on host: <130.199.2.2:9618>',
+         4: 'Job was evicted.', 5: 'Job terminated.\n\t(1) Normal termination (return value 0)',
+         9: 'Job was aborted.', 12: 'Job was held.\n\tError from slot1: out of memory', 13: 'Job was released.'}
+
+
+def event(code, job, text=None):
+    """
+    :return: one event of a job user log as condor writes it
+    """
+    cluster, proc = job.split('.')
+    return f'{code:03d} ({int(cluster):04d}.{int(proc):03d}.000) 2024-05-01 10:00:00 {text or texts[code]}\n...\n'
+
+
+def write(path, *events, mode='a'):
+    with open(path, mode) as log:
+        log.write(''.join(events))
+
+
+def test_states(tmp_path):
+    log = tmp_path / 'sched1.condor.log'
+    write(log, event(0, '12.0'), event(0, '12.1'), event(0, '12.2'), event(1, '12.0'), event(1, '12.1'),
+          event(12, '12.2'))
+    tailer = JobLogTailer(str(tmp_path / '*.condor.log'))
+    assert tailer.read() == [('12.0', 0), ('12.1', 0), ('12.2', 0), ('12.0', 1), ('12.1', 1), ('12.2', 12)]
+    assert tailer.states == {'12.0': JobStatus.RUNNING, '12.1': JobStatus.RUNNING, '12.2': JobStatus.HELD}
+    assert tailer.count_active() == 3
+    assert tailer.read() == []
+
+    write(log, event(5, '12.0'), event(9, '12.2'), event(4, '12.1'))
+    assert tailer.read() == [('12.0', 5), ('12.2', 9), ('12.1', 4)]
+    assert tailer.states == {'12.0': JobStatus.COMPLETED, '12.1': JobStatus.IDLE, '12.2': JobStatus.REMOVED}
+    assert tailer.count_active() == 1
+
+
+def test_half_written_event(tmp_path):
+    log = tmp_path / 'sched1.condor.log'
+    write(log, event(0, '7.0'), '001 (007.000.000) 2024-05-01 10:00:00 Job executing on host: <130.199.2.2:9618>\n')
+    tailer = JobLogTailer(str(log))
+    assert tailer.read() == [('7.0', 0)]
+    # the rest of the event arrives
+    write(log, '...\n')
+    assert tailer.read() == [('7.0', 1)]
+
+
+def test_new_and_truncated_logs(tmp_path):
+    write(tmp_path / 'a.condor.log', event(0, '1.0'), event(1, '1.0'))
+    tailer = JobLogTailer([str(tmp_path / '*.condor.log')])
+    assert tailer.read() == [('1.0', 0), ('1.0', 1)]
+    # picked up on the next read
+    write(tmp_path / 'b.condor.log', event(0, '2.0'))
+    assert tailer.read() == [('2.0', 0)]
+    # a resubmission starts the log again
+    write(tmp_path / 'a.condor.log', event(0, '3.0'), mode='w')
+    assert tailer.read() == [('3.0', 0)]
+
+
+class Monitor(JobMonitor):
+    """
+    Counts the queue checks instead of doing them, done at the second one
+    """
+    def run_task(self, invalidate=True):
+        self.checks.append(time.monotonic())
+        return len(self.checks) == 2
+
+
+def test_event_loop(tmp_path):
+    log = tmp_path / 'sched1.condor.log'
+    write(log, event(0, '5.0'), event(0, '5.1'), event(1, '5.0'), event(1, '5.1'))
+    monitor = Monitor('me@bnl.gov', cwd=str(tmp_path) + '/')
+    monitor.checks = []
+    exit = threading.Event()
+    loop = threading.Thread(target=monitor.event_loop, args=(exit, str(log)),
+                            kwargs={'poll': 0.05, 'min_interval': 3600, 'max_interval': 3600})
+    loop.start()
+    time.sleep(0.3)
+    # one job done, not worth a check yet
+    write(log, event(5, '5.0'))
+    time.sleep(0.3)
+    assert len(monitor.checks) == 1
+    # the last one done, checked right away
+    start = time.monotonic()
+    write(log, event(5, '5.1'))
+    loop.join(10)
+    assert not loop.is_alive()
+    assert len(monitor.checks) == 2 and monitor.checks[1] - start < 1
+
+
+def test_event_loop_check_now(tmp_path):
+    log = tmp_path / 'sched1.condor.log'
+    write(log, event(0, '5.0'))
+    monitor = Monitor('me@bnl.gov', cwd=str(tmp_path) + '/')
+    monitor.checks = []
+    exit = threading.Event()
+    loop = threading.Thread(target=monitor.event_loop, args=(exit, str(log)),
+                            kwargs={'poll': 0.05, 'min_interval': 3600, 'max_interval': 3600})
+    loop.start()
+    time.sleep(0.3)
+    # Ctrl+\
+    exit.set()
+    loop.join(10)
+    assert not loop.is_alive()
+    assert len(monitor.checks) == 2